@@ -34,7 +34,9 @@ class IntegratorState(NamedTuple):
     
 class NutsState(NamedTuple):
     final: IntegratorState
+    # Last positions of the chain and their running mean, not the trajectory.
     samples: Optional[chex.ArrayTree] = None
+    mean: Optional[chex.ArrayTree] = None
     
 class SGLDState(NamedTuple):
     params: chex.ArrayTree
@@ -1,6 +1,7 @@
 from enn_experiments.agents.base import EpistemicSampler, IntegratorState, KernelFn, NutsState, PriorKnowledge
 import haiku as hk
-from jax import random, lax, jit, tree_flatten, vmap
+from jax import random, lax, jit, tree_flatten, tree_map, vmap
+from jax.tree_util import tree_unflatten
 import jax.numpy as jnp
 
 
@@ -10,7 +11,7 @@ import blackjax.stan_warmup as stan_warmup
 import chex
 import dataclasses
 import functools
-from typing import Dict, Optional
+from typing import Dict, NamedTuple, Optional
 from acme.utils import loggers
 
 import enn.base as enn_base
@@ -30,42 +31,62 @@ class MCMCConfig:
   num_batches: int = 500  # Number of total training steps
   num_warmup: int = 200 # Burn in time for MCMC sampling
   num_samples: int = 500 # Number of MCMC steps per each batch
+  num_last: int = 100 # Number of final MCMC samples kept for prediction
   seed: int = 0  # Initialization seed
   adaptive_prior_variance: bool = False  # Scale prior_variance with dimension
 
 
+class LoopState(NamedTuple):
+  state: IntegratorState
+  mean: chex.ArrayTree
+  samples: chex.ArrayTree
+  step: int = 0
+
+
+@functools.partial(jit, static_argnames=('kernel', 'num_samples', 'num_last', 'unroll'))
 def inference_loop(rng_key: chex.PRNGKey,
                    kernel: KernelFn,
-                   initial_state, num_samples):
+                   initial_state, num_samples, num_last, unroll=8):
+    # The running mean and the last num_last positions live in the scan carry,
+    # so the full trajectory is never stacked.
     @jit
-    def one_step(state, rng_key):
-        state, _ = kernel(rng_key, state)
-        return state, state
+    def one_step(carry, _):
+        key = random.fold_in(rng_key, carry.step)
+        state, _ = kernel(key, carry.state)
+        mean = tree_map(lambda m, x: m + (x - m) / (carry.step + 1),
+                        carry.mean, state.position)
+        samples = tree_map(lambda r, x: lax.dynamic_update_index_in_dim(r, x, carry.step % num_last, 0),
+                           carry.samples, state.position)
+        return LoopState(state, mean, samples, carry.step + 1), None
 
-    keys = random.split(rng_key, num_samples)
-    final, states = lax.scan(one_step, initial_state, keys)
+    position = initial_state.position
+    initial_carry = LoopState(initial_state,
+                              tree_map(jnp.zeros_like, position),
+                              tree_map(lambda x: jnp.zeros((num_last, *x.shape), x.dtype), position))
 
-    return final, states
+    carry, _ = lax.scan(one_step, initial_carry, None,
+                        length=num_samples, unroll=unroll)
+
+    return carry.state, carry.mean, carry.samples
 
 
 def extract_enn_sampler(enn: enn_base.EpistemicNetwork, 
                         params_list) -> EpistemicSampler:
   """ENN sampler for MCMC."""
   
-  if isinstance(params_list, (jnp.ndarray, jnp.generic, list)):
-      num_params = len(params_list)
-  else:
-      params, unflatten_fn = tree_flatten(params_list)
-      num_params = len(params[0])
-        
+  if isinstance(params_list, list):
+    params_list = tree_map(lambda *ps: jnp.stack(ps), *params_list)
+  # Flattened once, the sampler only indexes the stacked leaves.
+  leaves, treedef = tree_flatten(params_list)
+  num_params = len(leaves[0])
+
   def enn_sampler(x: enn_base.Array, key: chex.PRNGKey) -> enn_base.Array:
     """Generate a random sample from posterior distribution at x."""
     param_index = random.randint(key, [], 0, num_params)
-    outs = vmap(lambda w, x, z: enn.apply(w.position, x, z),
-                in_axes=(0, None, None))(params_list,  x, 0)
-    out = outs[param_index]
+    params = tree_unflatten(treedef, [leaf[param_index] for leaf in leaves])
+    out = enn.apply(params, x, 0)
     return enn_utils.parse_net_output(out)
-  
+
   return jit(enn_sampler)
 
 
@@ -82,6 +103,7 @@ class BlackjaxExperiment(supervised_base.BaseExperiment):
                dataset: enn_base.BatchIterator,
                num_warmup: int,
                num_samples: int,
+               num_last: int,
                seed: int = 0,
                logger: Optional[loggers.Logger] = None,
                train_log_freq: int = 1,
@@ -100,6 +122,7 @@ class BlackjaxExperiment(supervised_base.BaseExperiment):
     self._eval_log_freq = eval_log_freq
     self._num_warmup = num_warmup
     self._num_samples = num_samples
+    self._num_last = min(num_last, num_samples)
 
     # Forward network at random index
     def forward(
@@ -111,30 +134,35 @@ class BlackjaxExperiment(supervised_base.BaseExperiment):
     
     self._forward = jit(forward)
 
-    # Define the step on the loss
+    # Define the step on the loss. The adapted step size and mass matrix are
+    # traced arguments so the compiled step is reused across batches.
     def step(
               integrator_state: IntegratorState,
               batch: enn_base.Batch,
-              key: enn_base.RngKey
+              key: enn_base.RngKey,
+              step_size: float,
+              inverse_mass_matrix: chex.Array,
+              num_samples: int,
+              num_last: int
               ):
 
         loss_key, inference_key = random.split(key)
         
-        @jit
         def partial_logprob(params):
             return -self._loss(params, batch, loss_key)[0]
       
         # Inference
-        nuts_kernel = jit(nuts.kernel(partial_logprob,
-                                      self._step_size,
-                                      self._inverse_mass_matrix))
-
-        final, states = inference_loop(inference_key,
-                                      nuts_kernel,
-                                      integrator_state,
-                                      self._num_samples)
+        nuts_kernel = nuts.kernel(partial_logprob,
+                                  step_size,
+                                  inverse_mass_matrix)
+
+        final, mean, samples = inference_loop(inference_key,
+                                              nuts_kernel,
+                                              integrator_state,
+                                              num_samples,
+                                              num_last)
                                     
-        return NutsState(final, states)
+        return NutsState(final, samples, mean)
 
     # Initialize networks
     batch = next(self.dataset)
@@ -159,7 +187,34 @@ class BlackjaxExperiment(supervised_base.BaseExperiment):
     self._step_size = step_size
     self._inverse_mass_matrix = inverse_mass_matrix
     
-    self._step = jit(step)
+    # Runs several steps in one compiled scan, only the samples of the last
+    # step are kept while the potential energy of every step is returned.
+    def steps(
+              integrator_state: IntegratorState,
+              batches: enn_base.Batch,
+              keys: enn_base.RngKey,
+              step_size: float,
+              inverse_mass_matrix: chex.Array,
+              num_samples: int,
+              num_last: int
+              ):
+
+        def body(integrator_state, inputs):
+            batch, key = inputs
+            state = step(integrator_state, batch, key, step_size,
+                         inverse_mass_matrix, num_samples, num_last)
+            return state.final, state.final.potential_energy
+
+        head = tree_map(lambda x: x[:-1], (batches, keys))
+        integrator_state, history = lax.scan(body, integrator_state, head)
+        batch, key = tree_map(lambda x: x[-1], (batches, keys))
+        state = step(integrator_state, batch, key, step_size,
+                     inverse_mass_matrix, num_samples, num_last)
+        history = jnp.append(history, state.final.potential_energy)
+        return state, history
+
+    self._steps = jit(steps, static_argnames=('num_samples', 'num_last'),
+                      donate_argnums=(0,))
     self.state = NutsState(state)
 
     self.step = 0
@@ -171,24 +226,38 @@ class BlackjaxExperiment(supervised_base.BaseExperiment):
   def train(self, num_batches: int):
 
     """Train the ENN for num_batches."""
-    for _ in range(num_batches):
-      self.step += 1
-      
-      self.state = self._step(self.state.final, next(self.dataset), next(self.rng))
-      
+    # Batches are processed in chunks that end on the next logging step, so
+    # the host only syncs with the device when something is written.
+    remaining = num_batches
+    while remaining > 0:
+      num_steps = min(self._steps_to_next_log(), remaining)
+      batches = [next(self.dataset) for _ in range(num_steps)]
+      batches = tree_map(lambda *xs: jnp.stack(xs), *batches)
+      keys = jnp.stack([next(self.rng) for _ in range(num_steps)])
+
+      self.state, history = self._steps(self.state.final,
+                                        batches,
+                                        keys,
+                                        self._step_size,
+                                        self._inverse_mass_matrix,
+                                        num_samples=self._num_samples,
+                                        num_last=self._num_last)
+      self.step += num_steps
+      remaining -= num_steps
+
       # Periodically log this performance as dataset=train.
       if self.step % self._train_log_freq == 0:
         loss_metrics = {'dataset': 'train',
                         'step': self.step,
                         'sgd': True,
-                        'potential_energy' : self.state.final.potential_energy}
+                        'potential_energy' : history[-1]}
         self.logger.write(loss_metrics)
 
       # Periodically evaluate the other datasets.
       if self._eval_datasets and self.step % self._eval_log_freq == 0:
         for name, dataset in self._eval_datasets.items():
           loss, metrics = self._loss(
-              self.state.final.params, next(dataset), next(self.rng))
+              self.state.final.position, next(dataset), next(self.rng))
           metrics.update({
               'dataset': name,
               'step': self.step,
@@ -197,13 +266,19 @@ class BlackjaxExperiment(supervised_base.BaseExperiment):
           })
           self.logger.write(metrics)
 
+  def _steps_to_next_log(self) -> int:
+    freqs = [self._train_log_freq]
+    if self._eval_datasets:
+      freqs.append(self._eval_log_freq)
+    return min(freq - self.step % freq for freq in freqs)
+
   def predict(self, inputs: enn_base.Array, key: enn_base.RngKey) -> enn_base.Array:
     """Evaluate the trained model at given inputs."""
-    return self._forward(self.state.final.params, inputs, key)
+    return self._forward(self.state.final.position, inputs, key)
 
   def loss(self, batch: enn_base.Batch, key: enn_base.RngKey) -> enn_base.Array:
     """Evaluate the loss for one batch of data."""
-    return self._loss(self.state.final.params, batch, key)
+    return self._loss(self.state.final.position, batch, key)
 
 
 def make_blackjax_agent(config: MCMCConfig, prior: PriorKnowledge):
@@ -228,6 +303,7 @@ def make_blackjax_agent(config: MCMCConfig, prior: PriorKnowledge):
         dataset=dataset, #batch_size=100),
         num_warmup=config.num_warmup,
         num_samples=config.num_samples,
+        num_last=config.num_last,
         train_log_freq=log_freq,
     )
 
@@ -1,6 +1,7 @@
 from enn_experiments.agents.base import EpistemicSampler, IntegratorState, PriorKnowledge, SGLDState
 import haiku as hk
 from jax import random, jit, tree_flatten, tree_map, vmap
+from jax.tree_util import tree_unflatten
 import jax.numpy as jnp
 
 import chex
@@ -38,19 +39,18 @@ class SGLDConfig:
 def extract_enn_sampler(enn: enn_base.EpistemicNetwork, 
                         params_list) -> EpistemicSampler:
     """ENN sampler for SGLD."""
-  
-    if isinstance(params_list, (jnp.ndarray, jnp.generic, list)):
-        num_params = len(params_list)
-    else:
-        params, unflatten_fn = tree_flatten(params_list)
-        num_params = len(params[0])
-        
+    
+    if isinstance(params_list, list):
+        params_list = tree_map(lambda *ps: jnp.stack(ps), *params_list)
+    # Flattened once, the sampler only indexes the stacked leaves.
+    leaves, treedef = tree_flatten(params_list)
+    num_params = len(leaves[0])
+
     def enn_sampler(x: enn_base.Array, key: chex.PRNGKey) -> enn_base.Array:
         """Generate a random sample from posterior distribution at x."""
         param_index = random.randint(key, [], 0, num_params)
-        outs = vmap(lambda w, x, z: enn.apply(w, x, z),
-                    in_axes=(0, None, None))(params_list,  x, 0)
-        out = outs[param_index]
+        params = tree_unflatten(treedef, [leaf[param_index] for leaf in leaves])
+        out = enn.apply(params, x, 0)
         return enn_utils.parse_net_output(out)
 
     return jit(enn_sampler)
@@ -45,6 +45,10 @@ class Agent:
     Agent interface.
     '''
 
+    # True when update is a pure function of its arguments, i.e. the agent
+    # keeps no replay buffer or other Python-side state, so it can be traced.
+    pure_update: bool = False
+
     def __init__(self,
                  is_classifier: bool):
         
@@ -73,6 +77,16 @@ class Agent:
         '''
         pass
 
+    def sample_many_params(self,
+                           key: chex.PRNGKey,
+                           belief: BeliefState,
+                           n: int) -> chex.ArrayTree:
+        '''
+        Sample n parameters given the belief state, stacked along a leading axis.
+        '''
+        keys = random.split(key, n)
+        return vmap(self.sample_params, in_axes=(0, None))(keys, belief)
+
     def predict_given_params_regression(self,
                                         params: chex.ArrayTree,
                                         x: chex.Array):
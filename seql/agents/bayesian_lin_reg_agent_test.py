@@ -243,22 +243,22 @@ class BayesLinRegTest(parameterized.TestCase):
         belief = agent.init_state(mu0, Sigma0)
         nsamples, njoint = 1, 1
         key = random.PRNGKey(seed)
-        kf_belief, _ = train(key,
-                             belief,
-                             agent,
-                             env,
-                             nsteps=nsteps,
-                             nsamples_output=nsamples,
-                             nsamples_input=nsamples,
-                             njoint=njoint,
-                             callback=callback_fn)
+        kf_belief = train(key,
+                          belief,
+                          agent,
+                          env,
+                          nsteps=nsteps,
+                          nsamples_output=nsamples,
+                          nsamples_input=nsamples,
+                          njoint=njoint,
+                          callback=callback_fn)
 
         buffer_size = 1
         agent = BayesianReg(buffer_size, obs_noise)
         belief = agent.init_state(mu0.reshape((-1, 1)), Sigma0)
         key = random.PRNGKey(seed)
 
-        bayes_belief, _ = train(key,
+        bayes_belief = train(key,
                              belief,
                              agent,
                              env,
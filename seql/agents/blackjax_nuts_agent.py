@@ -6,6 +6,7 @@ import blackjax.stan_warmup as stan_warmup
 
 import chex
 import warnings
+from functools import partial
 from typing import Any, NamedTuple
 
 from seql.agents.agent_utils import Memory
@@ -21,6 +22,7 @@ class BeliefState(NamedTuple):
     step_size: float = 0.
     inverse_mass_matrix: chex.Array = None
     samples: Samples = None
+    mean: Params = None
 
 
 class Info(NamedTuple):
@@ -35,16 +37,36 @@ class NutsState(NamedTuple):
     potential_energy_grad: chex.ArrayTree = None
 
 
-def inference_loop(rng_key, kernel, initial_state, num_samples):
+class LoopState(NamedTuple):
+    state: State
+    mean: Params
+    samples: Samples
+    step: int = 0
+
+
+@partial(jit, static_argnames=("kernel", "num_samples", "nlast", "unroll"))
+def inference_loop(rng_key, kernel, initial_state, num_samples, nlast, unroll=8):
+    # Keeps a running mean and a ring buffer of the last nlast positions in the
+    # carry rather than stacking the whole trajectory as the scan output.
     @jit
-    def one_step(state, rng_key):
-        state, _ = kernel(rng_key, state)
-        return state, state
+    def one_step(carry, _):
+        key = random.fold_in(rng_key, carry.step)
+        state, _ = kernel(key, carry.state)
+        mean = tree_map(lambda m, x: m + (x - m) / (carry.step + 1),
+                        carry.mean, state.position)
+        samples = tree_map(lambda r, x: lax.dynamic_update_index_in_dim(r, x, carry.step % nlast, 0),
+                           carry.samples, state.position)
+        return LoopState(state, mean, samples, carry.step + 1), None
 
-    keys = random.split(rng_key, num_samples)
-    final, states = lax.scan(one_step, initial_state, keys)
+    position = initial_state.position
+    initial_carry = LoopState(initial_state,
+                              tree_map(jnp.zeros_like, position),
+                              tree_map(lambda x: jnp.zeros((nlast, *x.shape), x.dtype), position))
 
-    return final, states
+    carry, _ = lax.scan(one_step, initial_carry, None,
+                        length=num_samples, unroll=unroll)
+
+    return carry.state, carry.mean, carry.samples
 
 
 class BlackJaxNutsAgent(Agent):
@@ -60,6 +82,7 @@ class BlackJaxNutsAgent(Agent):
                  buffer_size: int = 0,
                  min_n_samples: int = 1,
                  obs_noise: float = 0.1,
+                 precision: Any = None,
                  is_classifier: bool = False):
 
         super(BlackJaxNutsAgent, self).__init__(is_classifier)
@@ -94,6 +117,45 @@ class BlackJaxNutsAgent(Agent):
         self.obs_noise = obs_noise
         self.buffer_size = buffer_size
         self.threshold = min_n_samples
+        # Storage dtype of the retained samples, e.g. jnp.bfloat16. None keeps
+        # the dtype of the parameters.
+        self.precision = precision
+
+        # Warmup and sampling are traced together with the data as arguments,
+        # so the whole update is compiled once and reused across updates.
+        def run(key: chex.PRNGKey,
+                params: Params,
+                x: chex.Array,
+                y: chex.Array,
+                nwarmup: int,
+                nsamples: int,
+                nlast: int):
+
+            partial_logprob = partial(self.logprob, x=x, y=y)
+            warmup_key, sample_key = random.split(key)
+
+            state = nuts.new_state(params, partial_logprob)
+
+            kernel_generator = lambda step_size, inverse_mass_matrix: nuts.kernel(partial_logprob,
+                                                                                  step_size,
+                                                                                  inverse_mass_matrix)
+            _, (step_size, inverse_mass_matrix), _ = stan_warmup.run(warmup_key,
+                                                                     kernel_generator,
+                                                                     state,
+                                                                     nwarmup)
+
+            # Inference
+            nuts_kernel = kernel_generator(step_size, inverse_mass_matrix)
+            final, mean, samples = inference_loop(sample_key,
+                                                  nuts_kernel,
+                                                  state,
+                                                  nsamples,
+                                                  nlast)
+            if self.precision is not None:
+                samples = tree_map(lambda x: x.astype(self.precision), samples)
+            return final, step_size, inverse_mass_matrix, mean, samples
+
+        self.run_fn = jit(run, static_argnames=("nwarmup", "nsamples", "nlast"))
 
     def init_state(self,
                    initial_position: Params):
@@ -113,51 +175,27 @@ class BlackJaxNutsAgent(Agent):
             warnings.warn("There should be more data.", UserWarning)
             return belief, Info()
 
-        @jit
-        def partial_logprob(params):
-            return self.logprob(params, x_, y_)
-
-        warmup_key, sample_key = random.split(key)
-
-        state = nuts.new_state(belief.state.position,
-                               partial_logprob)
-
-        kernel_generator = lambda step_size, inverse_mass_matrix: nuts.kernel(partial_logprob,
-                                                                              step_size,
-                                                                              inverse_mass_matrix)
-        final, (step_size, inverse_mass_matrix), info = stan_warmup.run(warmup_key,
-                                                                              kernel_generator,
-                                                                              state,
-                                                                              self.nwarmup)
-
-        # Inference
-        nuts_kernel = jit(nuts.kernel(partial_logprob,
-                                      step_size,
-                                      inverse_mass_matrix))
-
-        final, states = inference_loop(sample_key,
-                                       nuts_kernel,
-                                       state,
-                                       self.nsamples)
-
-        '''
-        TODO: Make it work for both a pytree and and array
-        indices = jnp.arange(1, self.nlast + 1, self.step_between_params)
-        samples = tree_map(lambda x, index: x[-index],
-                           states.position, indices)
-        
-        '''
-        samples = states.position
+        final, step_size, inverse_mass_matrix, mean, samples = self.run_fn(key,
+                                                                           belief.state.position,
+                                                                           x_, y_,
+                                                                           nwarmup=self.nwarmup,
+                                                                           nsamples=self.nsamples,
+                                                                           nlast=self.nlast)
 
         belief_state = BeliefState(final,
                                    step_size,
                                    inverse_mass_matrix,
-                                   samples)
+                                   samples,
+                                   mean)
         return belief_state, Info()
 
     def sample_params(self,
                       key: chex.PRNGKey,
                       belief: BeliefState):
         
-        index = random.choice(key, jnp.arange(self.nlast))
-        return tree_map(lambda x: x[index], belief.samples)
\ No newline at end of file
+        nsamples = min(self.nlast, self.nsamples)
+        index = random.randint(key, (), 0, nsamples)
+        # Samples may be stored in reduced precision, so only the chosen one
+        # is cast back to the dtype of the parameters.
+        return tree_map(lambda x, m: x[index].astype(m.dtype),
+                        belief.samples, belief.mean)
\ No newline at end of file
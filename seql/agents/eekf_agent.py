@@ -29,6 +29,9 @@ class EEKFAgent(Agent):
         self.return_history = return_history
         self.model_fn = model_fn
         self.obs_noise = obs_noise
+        # The history is sized by each batch, so it can only be stacked
+        # across the steps of train's scan without it.
+        self.pure_update = not return_history
 
     def init_state(self,
                    mu: chex.Array,
@@ -45,6 +48,7 @@ class EEKFAgent(Agent):
                                       y, x, belief.Sigma,
                                       self.return_params,
                                       return_history=self.return_history)
+        mu = mu.reshape(belief.mu.shape)
         if self.return_history:
             return BeliefState(mu, Sigma), Info(history["mean"], history["cov"])
 
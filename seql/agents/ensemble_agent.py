@@ -1,5 +1,5 @@
 import jax.numpy as jnp
-from jax import jit, value_and_grad, random, vmap, tree_map
+from jax import checkpoint, jit, lax, value_and_grad, random, vmap, tree_map
 
 import optax
 
@@ -49,11 +49,7 @@ class Info(NamedTuple):
 
 
 def bootstrap_sampling(key, nsamples):
-    def sample(key):
-        return random.randint(key, (), 0, nsamples)
-
-    keys = random.split(key, nsamples)
-    return vmap(sample)(keys)
+    return random.randint(key, (nsamples,), 0, nsamples)
 
 
 class EnsembleAgent(Agent):
@@ -69,7 +65,8 @@ class EnsembleAgent(Agent):
                  obs_noise: float = 0.1,
                  beta: float = 0.1,
                  optimizer: Optimizer = optax.adam(1e-2),
-                 is_classifier: bool = False):
+                 is_classifier: bool = False,
+                 donate_belief: bool = False):
 
         super(EnsembleAgent, self).__init__(is_classifier)
 
@@ -109,10 +106,60 @@ class EnsembleAgent(Agent):
         self.nepochs = nepochs
         self.min_n_samples = min_n_samples
         self.obs_noise = obs_noise
-        
+
+        def member_value_and_grad(params, x, y, indices):
+            # Gathers the bootstrap replica of a single member
+            return self.value_and_grad_fn(params, x[indices], y[indices])
+
+        def train(params, opt_states, x, y, indices, nepochs):
+            params = frozen_dict.freeze(params)
+            # Only the trainable network of each member is optimised, the
+            # baseline keeps its initial values.
+            is_trainable = frozen_dict.freeze(
+                {"params": {"baseline": tree_map(lambda _: False, params["params"]["baseline"]),
+                            "trainable": tree_map(lambda _: True, params["params"]["trainable"])
+                            }
+                 })
+
+            @checkpoint
+            def epoch(carry, _):
+                params, opt_states = carry
+                loss, grads = vmap(member_value_and_grad,
+                                   in_axes=(0, None, None, 0))(params, x, y, indices)
+                updates, opt_states = vmap(self.optimizer.update)(grads, opt_states)
+                new_params = vmap(optax.apply_updates)(params, updates)
+                params = tree_map(lambda trainable, new, old: new if trainable else old,
+                                  is_trainable, new_params, params)
+                return (params, opt_states), loss
+
+            (params, opt_states), _ = lax.scan(epoch,
+                                               (params, opt_states),
+                                               None,
+                                               length=nepochs)
+            return params, opt_states
+
+        def update_fn(key, params, opt_states, x, y, nepochs):
+            # Bootstrap and training are traced together so the replicas are
+            # never materialised between them.
+            nsamples = len(x)
+            keys = random.split(key, self.nensembles)
+            indices = vmap(bootstrap_sampling, in_axes=(0, None))(keys, nsamples)
+            return train(params, opt_states, x, y, indices, nepochs)
+
+        # With donate_belief, XLA writes the new belief into the buffers of
+        # the previous one, which must then not be read again.
+        self.donate_belief = donate_belief
+        self.update_fn = jit(update_fn,
+                             static_argnames=("nepochs",),
+                             donate_argnums=(1, 2) if donate_belief else ())
+        self.sample_params = jit(self.sample_params)
+        self.sample_many_params = jit(self.sample_many_params, static_argnums=2)
 
     def init_state(self,
                    params: Params):
+        if self.donate_belief:
+            # The belief owns its buffers since update_fn donates them.
+            params = tree_map(jnp.array, params)
         opt_states = vmap(self.optimizer.init)(params)
         return BeliefState(params, opt_states)
 
@@ -130,44 +177,22 @@ class EnsembleAgent(Agent):
             info = Info(False, -1, jnp.inf)
             return belief, info
 
-        vbootstrap = vmap(bootstrap_sampling, in_axes=(0, None))
-
-        keys = random.split(key, self.nensembles)
-        indices = vbootstrap(keys, len(x_))
-
-
-        take_fn = lambda x, index: x[index]
-        x_ = vmap(take_fn, in_axes=(None, 0))(x_, indices)
-        y_ = vmap(take_fn, in_axes=(None, 0))(y_, indices)
-
-        def train(params, opt_state, x, y):
-            baseline = params["params"]["baseline"]
-            for _ in range(self.nepochs):
-                params = frozen_dict.freeze(
-                    {"params": {"baseline": baseline,
-                                "trainable": params["params"]["trainable"]
-                                }
-                     })
-                loss, grads = self.value_and_grad_fn(params, x, y)
-                updates, opt_state = self.optimizer.update(grads, opt_state)
-                params = optax.apply_updates(params, updates)
-
-            params = frozen_dict.freeze(
-                {"params": {"baseline": baseline,
-                            "trainable": params["params"]["trainable"]
-                            }
-                 })
-            return params, opt_state
-
-        vtrain = vmap(train, in_axes=(0, 0, 0, 0))
-        params, opt_states, = vtrain(belief.params, belief.opt_states, x_, y_)
+        params, opt_states = self.update_fn(key, belief.params, belief.opt_states,
+                                            x_, y_, nepochs=self.nepochs)
 
         return BeliefState(params, opt_states), Info()
 
     def sample_params(self,
                       key: chex.PRNGKey,
                       belief: BeliefState):
-        sample_key, key = random.split(key)
-        index = random.randint(sample_key, (), 0, self.nensembles)
+        index = random.randint(key, (), 0, self.nensembles)
         params = tree_map(lambda x: x[index], belief.params)
-        return params
\ No newline at end of file
+        return params
+
+    def sample_many_params(self,
+                           key: chex.PRNGKey,
+                           belief: BeliefState,
+                           n: int):
+        indices = random.randint(key, (n,), 0, self.nensembles)
+        params = tree_map(lambda x: jnp.take(x, indices, axis=0), belief.params)
+        return params
@@ -32,6 +32,9 @@ class KalmanFilterRegAgent(Agent):
         self.obs_noise = obs_noise
         self.return_history = return_history
         self.model_fn = lambda params, x: x @ params
+        # The history is sized by each batch, so it can only be stacked
+        # across the steps of train's scan without it.
+        self.pure_update = not return_history
 
     def init_state(self,
                    mu: chex.Array,
@@ -44,7 +47,6 @@ class KalmanFilterRegAgent(Agent):
                x: chex.Array,
                y: chex.Array):
         *_, input_dim = x.shape
-        *_, output_dim = y.shape
 
         A = jnp.eye(input_dim)
         Q = 0
@@ -59,13 +61,15 @@ class KalmanFilterRegAgent(Agent):
         mu, Sigma, _, _ = kalman_filter(lds,
                                         y,
                                         return_history=self.return_history)
+        # The mean keeps the shape it was initialised with, so the belief
+        # can be carried through a scan.
         if self.return_history:
             history = (mu, Sigma)
             mu, Sigma = mu[-1], Sigma[-1]
-            mu = mu.reshape((-1, output_dim))
+            mu = mu.reshape(belief.mu.shape)
             return BeliefState(mu, Sigma), Info(*history)
         
-        return BeliefState(mu.reshape((-1, output_dim)), Sigma), Info()
+        return BeliefState(mu.reshape(belief.mu.shape), Sigma), Info()
 
     def sample_params(self,
                       key: chex.PRNGKey,
@@ -10,6 +10,8 @@ from absl.testing import absltest
 from absl.testing import parameterized
 
 from seql.agents.kf_agent import KalmanFilterRegAgent
+from seql.environments.sequential_data_env import SequentialDataEnvironment
+from seql.utils import train
 
 
 class KalmanFilterTest(parameterized.TestCase):
@@ -142,5 +144,44 @@ class KalmanFilterTest(parameterized.TestCase):
         assert jnp.any(jnp.isinf(samples)) == False
         assert jnp.any(jnp.isnan(samples)) == False
 
+    @parameterized.parameters(itertools.product((0,),
+                                                (12,),
+                                                (3,),
+                                                (4,),
+                                                (0.1,),
+                                                ((), (1,))))
+    def test_train_without_callback(self,
+                                    seed: int,
+                                    ntrain: int,
+                                    batch_size: int,
+                                    input_dim: int,
+                                    obs_noise: float,
+                                    mu_trailing_shape: tuple):
+        output_dim = 1
+        nsteps = ntrain // batch_size
+
+        agent = KalmanFilterRegAgent(obs_noise)
+
+        mu = jnp.zeros((input_dim, *mu_trailing_shape))
+        Sigma = jnp.eye(input_dim)
+        initial_belief = agent.init_state(mu, Sigma)
+
+        key = random.PRNGKey(seed)
+        x_key, w_key, noise_key, train_key = random.split(key, 4)
+
+        x = random.normal(x_key, shape=(ntrain, input_dim))
+        w = random.normal(w_key, shape=(input_dim, output_dim))
+        y = x @ w + random.normal(noise_key, (ntrain, output_dim))
+        env = SequentialDataEnvironment(x, y, x, None, batch_size)
+
+        # Without a callback the updates run under lax.scan, with one they
+        # run in the Python loop; both must give the same belief.
+        scanned = train(train_key, initial_belief, agent, env, nsteps, 1, 1, 1)
+        looped = train(train_key, initial_belief, agent, env, nsteps, 1, 1, 1,
+                       callback=lambda **kwargs: None)
+
+        chex.assert_shape(scanned.mu, mu.shape)
+        chex.assert_trees_all_close(scanned, looped, rtol=1e-5)
+
     if __name__ == '__main__':
         absltest.main()
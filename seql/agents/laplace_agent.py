@@ -1,7 +1,6 @@
 import jax.numpy as jnp
-from jax import hessian, tree_map
-
-import distrax
+from jax import hessian, jacrev, jit, random, vmap
+from jax.flatten_util import ravel_pytree
 
 import chex
 from typing import Any, NamedTuple, Optional
@@ -19,12 +18,47 @@ Info = NamedTuple
 class BeliefState(NamedTuple):
     mu: Params
     Sigma: Params = None
+    # Lower Cholesky factor of Sigma
+    L: chex.Array = None
+    # Low rank form of the precision, prior_precision * I + V diag(s**2) V^T
+    V: chex.Array = None
+    s: chex.Array = None
 
 
 class Info(NamedTuple):
     ...
 
 
+@jit
+def sample_gaussian(key: chex.PRNGKey,
+                    mu: chex.Array,
+                    L: chex.Array):
+    eps = random.normal(key, (len(L),))
+    theta = jnp.ravel(mu) + L @ eps
+    return theta.reshape(mu.shape)
+
+
+@jit
+def sample_gaussian_low_rank(key: chex.PRNGKey,
+                             mu: chex.Array,
+                             V: chex.Array,
+                             s: chex.Array,
+                             prior_precision: float):
+    # Square root of the covariance, V diag(d) V^T + (I - V V^T) / sqrt(prior_precision)
+    eps = random.normal(key, (len(V),))
+    scale = 1. / jnp.sqrt(prior_precision)
+    d = 1. / jnp.sqrt(s ** 2 + prior_precision)
+    theta = jnp.ravel(mu) + scale * eps + V @ ((d - scale) * (V.T @ eps))
+    return theta.reshape(mu.shape)
+
+
+def _identity_model_fn(predictions: chex.Array,
+                       x: chex.Array):
+    # Defined once so jitted log likelihoods taking model_fn as a static
+    # argument hit their cache on every update.
+    return predictions
+
+
 class LaplaceAgent(Agent):
 
     def __init__(self,
@@ -35,9 +69,15 @@ class LaplaceAgent(Agent):
                  min_n_samples: int = 1,
                  buffer_size: int = 0,
                  obs_noise: float = 0.01,
+                 prior_precision: Optional[float] = None,
+                 rank_mode: str = "full",
                  is_classifier: bool = False):
         super(LaplaceAgent, self).__init__(is_classifier)
 
+        assert rank_mode in ("full", "low")
+        # The low rank sampler only supports an isotropic prior precision.
+        assert rank_mode == "full" or prior_precision is not None
+
         self.memory = Memory(buffer_size)
         self.solver = solver
         self.model_fn = model_fn
@@ -52,7 +92,21 @@ class LaplaceAgent(Agent):
             lp = logprior(params)
             return -(ll + lp)
 
+        def output_loss_fn(predictions: chex.Array,
+                           x: chex.Array,
+                           y: chex.Array):
+            # Negative log likelihood as a function of the model outputs.
+            return -loglikelihood(predictions,
+                                  x, y,
+                                  _identity_model_fn)
+
         self.loss_fn = loss_fn
+        self.output_loss_fn = output_loss_fn
+        self.logprior = logprior
+        # When given, prior_precision * I replaces the curvature of logprior
+        # in the covariance; by default that curvature is used as is.
+        self.prior_precision = prior_precision
+        self.rank_mode = rank_mode
         self.obs_noise = obs_noise
         self.min_n_samples = min_n_samples
         self.buffer_size = buffer_size
@@ -78,18 +132,43 @@ class LaplaceAgent(Agent):
                                        x=x_,
                                        y=y_)
 
-        def partial_loss_fn(params):
-            return self.loss_fn(params, x_, y_) / len(x_) /  10000.
-
-        Sigma = hessian(partial_loss_fn)(tree_map(jnp.squeeze, params))
-        return BeliefState(params, Sigma), info
+        # Generalized Gauss-Newton approximation of the Hessian,
+        # sum_n J_n^T H_n J_n = A^T A, built from per-example model Jacobians
+        # J_n and the curvature H_n of the loss w.r.t. the model outputs.
+        flat_params, unravel_fn = ravel_pytree(params)
+        nparams = len(flat_params)
+
+        def ggn_factor(x, y):
+            x, y = x[None, ...], y[None, ...]
+            predictions = self.model_fn(params, x)
+            J = jacrev(lambda p: self.model_fn(unravel_fn(p), x).ravel())(flat_params)
+            H = hessian(self.output_loss_fn)(predictions, x, y)
+            H = H.reshape((predictions.size, predictions.size))
+            w, Q = jnp.linalg.eigh(H)
+            return (Q * jnp.sqrt(jnp.clip(w, 0.))).T @ J
+
+        A = vmap(ggn_factor)(x_, y_).reshape((-1, nparams))
+
+        if self.rank_mode == "low":
+            _, s, Vt = jnp.linalg.svd(A, full_matrices=False)
+            return BeliefState(params, V=Vt.T, s=s), info
+
+        G = A.T @ A
+        if self.prior_precision is None:
+            P = -hessian(lambda p: self.logprior(unravel_fn(p)))(flat_params)
+        else:
+            P = self.prior_precision * jnp.eye(nparams)
+        Sigma = jnp.linalg.inv(G + P)
+        L = jnp.linalg.cholesky(Sigma + 1e-6 * jnp.eye(nparams))
+        return BeliefState(params, Sigma, L), info
 
     def sample_params(self,
                       key: chex.PRNGKey,
                       belief: BeliefState):
-        mu, Sigma = belief.mu, belief.Sigma
-        mvn = distrax.MultivariateNormalFullCovariance(jnp.squeeze(mu, axis=-1),
-                                                       Sigma)
-        theta = mvn.sample(seed=key)
-        theta = theta.reshape(mu.shape)
-        return theta
\ No newline at end of file
+        if belief.V is not None:
+            return sample_gaussian_low_rank(key, belief.mu, belief.V, belief.s,
+                                            self.prior_precision)
+        L = belief.L
+        if L is None:
+            L = jnp.linalg.cholesky(belief.Sigma)
+        return sample_gaussian(key, belief.mu, L)
@@ -0,0 +1,139 @@
+import jax.numpy as jnp
+from jax import random
+from jax.flatten_util import ravel_pytree
+
+import numpyro
+import numpyro.distributions as dist
+from numpyro.infer import MCMC, NUTS
+
+import chex
+import warnings
+from typing import Any, Callable, NamedTuple
+
+from seql.agents.agent_utils import Memory
+from seql.agents.base import Agent, LoglikelihoodFn, LogpriorFn, ModelFn
+
+Params = Any
+Samples = Any
+State = NamedTuple
+
+
+class BeliefState(NamedTuple):
+    state: State = None
+    step_size: float = 0.
+    inverse_mass_matrix: chex.Array = None
+    samples: Samples = None
+    mean: Params = None
+
+
+class Info(NamedTuple):
+    ...
+
+
+class NutsState(NamedTuple):
+    position: chex.ArrayTree
+
+
+class NumpyroNutsAgent(Agent):
+    '''
+    Drop-in replacement of BlackJaxNutsAgent built on NumPyro's iterative NUTS,
+    whose tree building is compiled into a single XLA program.
+    '''
+
+    def __init__(self,
+                 loglikelihood: LoglikelihoodFn,
+                 model_fn: ModelFn,
+                 nsamples: int,
+                 nwarmup: int,
+                 logprior: LogpriorFn = lambda params: 0.,
+                 nlast: int = 10,
+                 buffer_size: int = 0,
+                 min_n_samples: int = 1,
+                 obs_noise: float = 0.1,
+                 is_classifier: bool = False):
+
+        super(NumpyroNutsAgent, self).__init__(is_classifier)
+
+        if buffer_size == jnp.inf:
+            buffer_size = 0
+
+        assert min_n_samples <= buffer_size or buffer_size == 0
+        self.memory = Memory(buffer_size)
+
+        self.model_fn = model_fn
+        self.loglikelihood = loglikelihood
+        self.logprior = logprior
+
+        self.nwarmup = nwarmup
+        self.nlast = nlast
+        self.nsamples = nsamples
+        self.obs_noise = obs_noise
+        self.buffer_size = buffer_size
+        self.threshold = min_n_samples
+
+        # Set by init_state, the sample site is the flattened params tree.
+        self.nparams: int = None
+        self.unravel_fn: Callable = None
+
+        def model(x: chex.Array,
+                  y: chex.Array):
+            flat_params = numpyro.sample("params",
+                                         dist.ImproperUniform(dist.constraints.real,
+                                                              (),
+                                                              event_shape=(self.nparams,)))
+            params = self.unravel_fn(flat_params)
+            ll = self.loglikelihood(params, x, y, self.model_fn)
+            lp = self.logprior(params)
+            numpyro.factor("logprob", ll + lp)
+
+        # The data are model arguments, so the compiled sampler is reused by
+        # every update with the same buffer size.
+        self.mcmc = MCMC(NUTS(model),
+                         num_warmup=nwarmup,
+                         num_samples=nsamples,
+                         chain_method="vectorized",
+                         jit_model_args=True,
+                         progress_bar=False)
+
+    def init_state(self,
+                   initial_position: Params):
+        flat_params, self.unravel_fn = ravel_pytree(initial_position)
+        self.nparams = len(flat_params)
+        nuts_state = NutsState(initial_position)
+        return BeliefState(nuts_state)
+
+    def update(self,
+               key: chex.PRNGKey,
+               belief: BeliefState,
+               x: chex.Array,
+               y: chex.Array):
+
+        assert self.buffer_size >= len(x)
+        x_, y_ = self.memory.update(x, y)
+
+        if len(x_) < self.threshold:
+            warnings.warn("There should be more data.", UserWarning)
+            return belief, Info()
+
+        flat_params, _ = ravel_pytree(belief.state.position)
+        self.mcmc.run(key,
+                      x_, y_,
+                      init_params={"params": flat_params})
+
+        samples = self.mcmc.get_samples()["params"]
+        last_state = self.mcmc.last_state
+        position = self.unravel_fn(last_state.z["params"])
+
+        belief_state = BeliefState(NutsState(position),
+                                   last_state.adapt_state.step_size,
+                                   last_state.adapt_state.inverse_mass_matrix,
+                                   samples[-self.nlast:],
+                                   self.unravel_fn(jnp.mean(samples, axis=0)))
+        return belief_state, Info()
+
+    def sample_params(self,
+                      key: chex.PRNGKey,
+                      belief: BeliefState):
+        nsamples = min(self.nlast, self.nsamples)
+        index = random.randint(key, (), 0, nsamples)
+        return self.unravel_fn(belief.samples[index])
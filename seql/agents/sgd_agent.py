@@ -1,5 +1,5 @@
 import jax.numpy as jnp
-from jax import jit, value_and_grad
+from jax import jit, lax, tree_map, value_and_grad
 
 import optax
 
@@ -59,7 +59,8 @@ class SGDAgent(Agent):
                  buffer_size: int = jnp.inf,
                  obs_noise: float = 0.1,
                  optimizer: Optimizer = optax.adam(1e-2),
-                 is_classifier: bool = False):
+                 is_classifier: bool = False,
+                 donate_belief: bool = False):
 
         super(SGDAgent, self).__init__(is_classifier)
         assert threshold <= buffer_size
@@ -86,8 +87,39 @@ class SGDAgent(Agent):
         self.nepochs = nepochs
         self.obs_noise = obs_noise
 
+        def train(params: Params,
+                  opt_state: TraceState,
+                  x: chex.Array,
+                  y: chex.Array,
+                  nepochs: int):
+
+            def epoch(carry, _):
+                params, opt_state = carry
+                loss, grads = value_and_grad_fn(params, x, y)
+                updates, opt_state = self.optimizer.update(grads, opt_state)
+                params = optax.apply_updates(params, updates)
+                return (params, opt_state), loss
+
+            (params, opt_state), losses = lax.scan(epoch,
+                                                   (params, opt_state),
+                                                   None,
+                                                   length=nepochs)
+            return params, opt_state, losses[-1]
+
+        # With donate_belief, XLA writes the new belief into the buffers of
+        # the previous one, which must then not be read again.
+        self.donate_belief = donate_belief
+        self.train_fn = jit(train,
+                            static_argnames=("nepochs",),
+                            donate_argnums=(0, 1) if donate_belief else ())
+        self.sample_params = jit(self.sample_params)
+        self.sample_many_params = jit(self.sample_many_params, static_argnums=2)
+
     def init_state(self,
                    params: Params):
+        if self.donate_belief:
+            # The belief owns its buffers since train_fn donates them.
+            params = tree_map(jnp.array, params)
         opt_state = self.optimizer.init(params)
         return BeliefState(params, opt_state)
 
@@ -105,13 +137,10 @@ class SGDAgent(Agent):
             info = Info(False, -1, jnp.inf)
             return belief, info
 
-        params = belief.params
-        opt_state = belief.opt_state
-
-        for _ in range(self.nepochs):
-            loss, grads = self.value_and_grad_fn(params, x_, y_)
-            updates, opt_state = self.optimizer.update(grads, opt_state)
-            params = optax.apply_updates(params, updates)
+        params, opt_state, loss = self.train_fn(belief.params,
+                                                belief.opt_state,
+                                                x_, y_,
+                                                nepochs=self.nepochs)
 
         return BeliefState(params, opt_state), Info(loss)
 
@@ -1,7 +1,7 @@
 import jax.numpy as jnp
-from jax import tree_map, vmap, random
+from jax import jit, lax, tree_map, random
 
-from sgmcmcjax.samplers import build_sgld_sampler
+from sgmcmcjax.kernels import build_sgld_kernel
 
 import chex
 from typing import Any, NamedTuple, Callable
@@ -18,7 +18,6 @@ Samples = Any
 class BeliefState(NamedTuple):
     params: Params
     samples: Samples = None
-    sampler: Callable = None
 
 
 class Info(NamedTuple):
@@ -59,6 +58,33 @@ class SGLDAgent(Agent):
         self.loglikelihood = partial(loglikelihood, model_fn=model_fn)
         self.obs_noise = obs_noise
 
+        # The SGLD kernel is built inside a jitted function taking the data as
+        # arguments, so it is compiled once rather than on every update.
+        def sample_fn(key: chex.PRNGKey,
+                      params: Params,
+                      x: chex.Array,
+                      y: chex.Array):
+            batch_size = len(x) if self.batch_size == -1 else self.batch_size
+            init_fn, kernel, get_params = build_sgld_kernel(self.dt,
+                                                            self.loglikelihood,
+                                                            self.logprior,
+                                                            (x, y),
+                                                            batch_size)
+
+            def one_step(state, inputs):
+                i, key = inputs
+                state = kernel(i, key, state)
+                return state, get_params(state)
+
+            init_key, key = random.split(key)
+            keys = random.split(key, self.nsamples)
+            _, samples = lax.scan(one_step,
+                                  init_fn(init_key, params),
+                                  (jnp.arange(self.nsamples), keys))
+            return samples
+
+        self.sample_fn = jit(sample_fn)
+
     def init_state(self,
                    params: Params):
         return BeliefState(params)
@@ -77,16 +103,9 @@ class SGLDAgent(Agent):
             info = Info(False, -1, jnp.inf)
             return belief, info
 
-        batch_size_ = len(x_) if self.batch_size == -1 else self.batch_size
-
-        sampler = build_sgld_sampler(self.dt,
-                                     self.loglikelihood,
-                                     self.logprior,
-                                     (x_, y_),
-                                     batch_size_)
-        samples = sampler(key,
-                          self.nsamples,
-                          belief.params)
+        samples = self.sample_fn(key,
+                                 belief.params,
+                                 x_, y_)
 
         final = tree_map(lambda x: x[-1],
                            samples)
@@ -97,23 +116,35 @@ class SGLDAgent(Agent):
         samples = tree_map(lambda x, index: x[-index],
                            samples, indices)'''
   
-        return BeliefState(final, samples, sampler), Info
+        return BeliefState(final, samples), Info
 
     def get_posterior_cov(self,
                           belief: BeliefState,
                           x: chex.Array):
 
         n = len(x)
-        predictions = vmap(self.model_fn, in_axis=(0, None))(belief.samples,
-                                                             x)
-        posterior_cov = jnp.diag(jnp.power(jnp.std(predictions, axis=0), 2))
+
+        # Welford's running variance over the samples, so the predictions of
+        # all samples are never stacked.
+        def body(carry, params):
+            i, mean, m2 = carry
+            prediction = jnp.ravel(self.model_fn(params, x))
+            delta = prediction - mean
+            mean = mean + delta / (i + 1)
+            m2 = m2 + delta * (prediction - mean)
+            return (i + 1, mean, m2), None
+
+        (nsamples, _, m2), _ = lax.scan(body,
+                                        (0, jnp.zeros(n), jnp.zeros(n)),
+                                        belief.samples)
+        posterior_cov = jnp.diag(m2 / nsamples)
         chex.assert_shape(posterior_cov, [n, n])
         return posterior_cov
 
     def sample_params(self,
                       key: chex.PRNGKey,
                       belief: BeliefState):
-
-        
-        index = random.choice(key, jnp.arange(self.nlast))
+        # Only the last nlast steps of the chain are used
+        nlast = min(self.nlast, self.nsamples)
+        index = random.randint(key, (), self.nsamples - nlast, self.nsamples)
         return tree_map(lambda x: x[index], belief.samples)
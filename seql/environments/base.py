@@ -1,14 +1,13 @@
 import jax.numpy as jnp
-from jax import random, jit, nn, vmap
+from jax import lax, random, jit, nn, tree_map, vmap
 
 import haiku as hk
 import distrax
 import neural_tangents as nt
 
 import chex
-from typing import Callable, List, Optional, Tuple, Union
-
-from sklearn.preprocessing import PolynomialFeatures
+from functools import lru_cache, partial
+from typing import Any, Callable, List, Optional, Tuple, Union
 
 from seql.environments.sequential_classification_env import SequentialClassificationEnvironment
 from seql.environments.sequential_regression_env import SequentialRegressionEnvironment
@@ -44,25 +43,35 @@ class MLPKernelCtor(KernelCtor):
 
   def __call__(self, input_dim: int = 1) -> nt_types.AnalyticKernelFn:
     """Generates a kernel for a given input dimension."""
-    limit_width = 50  # Implementation detail of neural_testbed, unused.
-    layers = [
-        stax.Dense(limit_width, W_std=1, b_std=1 / np.sqrt(input_dim))
-    ]
-    for _ in range(self.num_hidden_layers - 1):
-      layers.append(self.activation)
-      layers.append(stax.Dense(limit_width, W_std=1, b_std=0))
-    layers.append(self.activation)
-    layers.append(stax.Dense(1, W_std=1, b_std=0))
-    _, _, kernel = stax.serial(*layers)
-    return kernel
+    return _make_mlp_kernel(input_dim, self.num_hidden_layers, self.activation)
 
 
+@lru_cache(maxsize=None)
+def _make_mlp_kernel(input_dim: int,
+                     num_hidden_layers: int,
+                     activation: nt_types.InternalLayer) -> nt_types.AnalyticKernelFn:
+  """Builds the MLP kernel, cached so repeated builds reuse the stax graph."""
+  limit_width = 50  # Implementation detail of neural_testbed, unused.
+  layers = [
+      stax.Dense(limit_width, W_std=1, b_std=1 / np.sqrt(input_dim))
+  ]
+  for _ in range(num_hidden_layers - 1):
+    layers.append(activation)
+    layers.append(stax.Dense(limit_width, W_std=1, b_std=0))
+  layers.append(activation)
+  layers.append(stax.Dense(1, W_std=1, b_std=0))
+  _, _, kernel = stax.serial(*layers)
+  return kernel
+
+
+@lru_cache(maxsize=None)
 def make_benchmark_kernel(input_dim: int = 1) -> nt_types.AnalyticKernelFn:
   """Creates the benchmark kernel used in leaderboard = 2-layer ReLU."""
   kernel_ctor = MLPKernelCtor(num_hidden_layers=2, activation=stax.Relu())
   return kernel_ctor(input_dim)
 
 
+@lru_cache(maxsize=None)
 def make_linear_kernel(input_dim: int = 1) -> nt_types.AnalyticKernelFn:
   """Generate a linear GP kernel for testing putposes."""
   layers = [
@@ -89,23 +98,17 @@ def make_evenly_spaced_x_sampler(max_val: float, use_bias: bool = True, min_val:
         if nfeatures == 1:
             X = jnp.linspace(min_val, max_val, nsamples)
             if use_bias:
-                X = jnp.c_[jnp.ones(nsamples), X]
+                X = jnp.pad(X.reshape((-1, 1)), ((0, 0), (1, 0)), constant_values=1.)
             else:
                 X = X.reshape((-1, 1))
         else:
-            step_size = (max_val - min_val) / float(nsamples)
-            # define the x and y scale
-            x = jnp.arange(min_val, max_val, step_size)
-            y = jnp.arange(min_val, max_val, step_size)
-
-            # create all of the lines and rows of the grid
-            xx, yy = jnp.meshgrid(x, y)
-
-            # flatten each grid to a vector
-            r1, r2 = xx.flatten(), yy.flatten()
-            r1, r2 = r1.reshape((len(r1), 1)), r2.reshape((len(r2), 1))
-            # horizontal stack vectors to create x1,x2 input for the model
-            X = jnp.hstack((r1, r2))
+            # define the x and y scale, linspace always gives nsamples points
+            # where a float arange step may add or drop one
+            x = jnp.linspace(min_val, max_val, nsamples, endpoint=False)
+            y = jnp.linspace(min_val, max_val, nsamples, endpoint=False)
+
+            # grid points as (x1, x2) rows for the model
+            X = jnp.stack(jnp.meshgrid(x, y), axis=-1).reshape((-1, 2))
         return X
 
     return eveny_spaced_x_sampler
@@ -129,13 +132,13 @@ def make_bimodel_sampler(mixing_parameter: float,
 
     def bimodel_sampler(key: chex.PRNGKey, shape: Tuple) -> chex.Array:
         nsamples, nfeatures = shape
-        n1 = int(nsamples * mixing_parameter)
-        n2 = int(nsamples * (1 - mixing_parameter))
-
-        x1_key, x2_key = random.split(key)
-        x1 = random.normal(x1_key, (n1, nfeatures)) * sigma1 + mu1
-        x2 = random.normal(x2_key, (n2, nfeatures)) * sigma2 + mu2
-        return jnp.vstack([x1, x2])
+        x_key, mask_key = random.split(key)
+        x = random.normal(x_key, (nsamples, nfeatures))
+        # Each row comes from the first mode with probability mixing_parameter
+        mask = random.bernoulli(mask_key, mixing_parameter, (nsamples, 1))
+        sigma = jnp.where(mask, sigma1, sigma2)
+        mu = jnp.where(mask, mu1, mu2)
+        return x * sigma + mu
 
     return bimodel_sampler
 
@@ -160,24 +163,90 @@ def make_mixture_of_gaussians_sampler(loc: chex.Array,
     return mixture_of_gaussians_sampler
 
 
-def make_sin_wave_regression_environment(key: chex.PRNGKey,
-                                         ntrain: int,
-                                         ntest: int,
-                                         obs_noise: float = 0.01,
-                                         train_batch_size: int = 1,
-                                         test_batch_size: int = 1,
-                                         x_train_generator: Callable = random.normal,
-                                         x_test_generator: Callable = random.normal,
-                                         bias: bool = True,
-                                         shuffle: bool = False):
-    train_key, test_key, noise_key, y_key, env_key = random.split(key, 4)
-    X_train = x_train_generator(train_key, (ntrain, 1))
-    X_test = x_test_generator(test_key, (ntest, 1))
-
-    ntrain = len(X_train)
-    ntest = len(X_test)
+@partial(jit, static_argnums=(1,))
+def poly_features(X: chex.Array, degree: int) -> chex.Array:
+    # Same columns and ordering as sklearn's PolynomialFeatures. The terms of
+    # each degree are built by multiplying every input column with the block
+    # of the previous degree whose terms only involve columns from it onwards.
+    nsamples, nfeatures = X.shape
+    if nfeatures == 1:
+        # A single input only has its powers, i.e. a Vandermonde matrix
+        return jnp.vander(X[:, 0], degree + 1, increasing=True)
+
+    blocks = [jnp.ones((nsamples, 1), dtype=X.dtype)]
+    if degree == 0:
+        return blocks[0]
+
+    block, starts = X, list(range(nfeatures))
+    blocks.append(block)
+    for _ in range(2, degree + 1):
+        new_blocks, new_starts = [], []
+        ncols = 0
+        for j in range(nfeatures):
+            new_starts.append(ncols)
+            new_blocks.append(X[:, j:j + 1] * block[:, starts[j]:])
+            ncols += new_blocks[-1].shape[1]
+        block, starts = jnp.concatenate(new_blocks, axis=1), new_starts
+        blocks.append(block)
+    return jnp.concatenate(blocks, axis=1)
+
+
+def _apply_in_dtype(fn: Callable,
+                    params: chex.ArrayTree,
+                    x: chex.Array,
+                    dtype: Any) -> chex.Array:
+    # Evaluates fn(params, x) with inputs and parameters cast to dtype (e.g.
+    # jnp.bfloat16) and returns the outputs in float32.
+    params = tree_map(lambda p: p.astype(dtype), params)
+    return fn(params, x.astype(dtype)).astype(jnp.float32)
+
+
+@partial(jit, static_argnums=(2,))
+def _sample_categorical(probs: chex.Array,
+                        key: chex.PRNGKey,
+                        nclasses: int) -> chex.Array:
+    return random.choice(key, nclasses, shape=(1,), p=probs)
+
+
+def _sample_inputs(train_key: chex.PRNGKey,
+                   test_key: chex.PRNGKey,
+                   ntrain: int,
+                   ntest: int,
+                   nfeatures: int,
+                   x_train_generator: Callable,
+                   x_test_generator: Callable):
+    # Gaussian inputs are drawn in one call and split afterwards, other
+    # generators (e.g. evenly spaced grids) are sampled per split.
+    if x_train_generator is random.normal and x_test_generator is random.normal:
+        return random.normal(train_key, (ntrain + ntest, nfeatures))
 
-    X = jnp.vstack([X_train, X_test])
+    X_train = x_train_generator(train_key, (ntrain, nfeatures))
+    X_test = x_test_generator(test_key, (ntest, nfeatures))
+    return jnp.vstack([X_train, X_test])
+
+
+@partial(jit, static_argnames=("obs_noise",
+                                "bias",
+                                "ntrain",
+                                "ntest",
+                                "x_train_generator",
+                                "x_test_generator"))
+def _make_sin_wave_data(train_key: chex.PRNGKey,
+                        test_key: chex.PRNGKey,
+                        noise_key: chex.PRNGKey,
+                        ntrain: int,
+                        ntest: int,
+                        obs_noise: float,
+                        bias: bool,
+                        x_train_generator: Callable,
+                        x_test_generator: Callable):
+    X = _sample_inputs(train_key,
+                       test_key,
+                       ntrain,
+                       ntest,
+                       1,
+                       x_train_generator,
+                       x_test_generator)
 
     if obs_noise > 0.0:
         nsamples = ntrain + ntest
@@ -188,13 +257,31 @@ def make_sin_wave_regression_environment(key: chex.PRNGKey,
     Y = jnp.sin(X) + noise
 
     if bias:
-        X = jnp.hstack([jnp.ones((len(X), 1)), X])
+        X = jnp.pad(X, ((0, 0), (1, 0)), constant_values=1.)
 
-    X_train = X[:ntrain]
-    X_test = X[ntrain:]
+    return X[:ntrain], Y[:ntrain], X[ntrain:], Y[ntrain:]
 
-    y_train = Y[:ntrain]
-    y_test = Y[ntrain:]
+
+def make_sin_wave_regression_environment(key: chex.PRNGKey,
+                                         ntrain: int,
+                                         ntest: int,
+                                         obs_noise: float = 0.01,
+                                         train_batch_size: int = 1,
+                                         test_batch_size: int = 1,
+                                         x_train_generator: Callable = random.normal,
+                                         x_test_generator: Callable = random.normal,
+                                         bias: bool = True,
+                                         shuffle: bool = False):
+    train_key, test_key, noise_key, env_key = random.split(key, 4)
+    X_train, y_train, X_test, y_test = _make_sin_wave_data(train_key,
+                                                           test_key,
+                                                           noise_key,
+                                                           ntrain,
+                                                           ntest,
+                                                           obs_noise,
+                                                           bias,
+                                                           x_train_generator,
+                                                           x_test_generator)
 
     if shuffle:
         env_key, key = random.split(key)
@@ -229,33 +316,33 @@ def make_random_poly_classification_environment(key: chex.PRNGKey,
                                                 x_train_generator: Callable = random.normal,
                                                 x_test_generator: Callable = random.normal,
                                                 shuffle: bool = False):
-    train_key, test_key, env_key, output_key = random.split(key, 4)
-
-    X_train = x_train_generator(train_key, (ntrain, nfeatures))
-    X_test = x_test_generator(test_key, (ntest, nfeatures))
-
-    ntrain = len(X_train)
-    ntest = len(X_test)
-
-    X = jnp.vstack([X_train, X_test])
-    poly = PolynomialFeatures(degree)
-    Phi = jnp.array(poly.fit_transform(X), dtype=jnp.float32)
+    train_key, test_key, env_key, output_key, w_key, noise_key = random.split(key, 6)
+
+    X = _sample_inputs(train_key,
+                       test_key,
+                       ntrain,
+                       ntest,
+                       nfeatures,
+                       x_train_generator,
+                       x_test_generator)
+    # Expanded once on the train and test inputs together, splitting X first
+    # would run the expansion twice.
+    Phi = poly_features(X, degree)
     
     D = Phi.shape[-1]
-    w = random.normal(key, (D, nclasses)) + 5
+    w = random.normal(w_key, (D, nclasses)) + 5
     if obs_noise > 0.0:
         nsamples = ntrain + ntest
-        noise = random.normal(key, (nsamples, nclasses)) * obs_noise
+        noise = random.normal(noise_key, (nsamples, nclasses)) * obs_noise
     else:
         noise = 0.
-    logprobs = nn.softmax(Phi @ w + noise)
+    logits = Phi @ w + noise
+    logprobs = nn.log_softmax(logits)
 
-    # Generate data.
-    def sample_output(probs: chex.Array, key: chex.PRNGKey) -> chex.Array:
-        return random.choice(key, nclasses, shape=(1,), p=probs)
-    
-    keys = random.split(output_key, ntrain + ntest)
-    Y = vmap(sample_output)(logprobs, keys)
+    # Generate data with the Gumbel-max trick, argmax(logits + g) is a sample
+    # of the categorical with probabilities softmax(logits).
+    gumbel = random.gumbel(output_key, logits.shape)
+    Y = jnp.argmax(logits + gumbel, axis=-1, keepdims=True)
 
     X_train = Phi[:ntrain]
     X_test = Phi[ntrain:]
@@ -307,16 +394,17 @@ def make_random_poly_regression_environment(key: chex.PRNGKey,
     
     train_key, test_key, y_key, noise_key = random.split(key, 4)
 
-    X_train = x_train_generator(train_key, (ntrain, 1))
-    X_test = x_test_generator(test_key, (ntest, 1))
-
-    ntrain = len(X_train)
-    ntest = len(X_test)
+    X = _sample_inputs(train_key,
+                       test_key,
+                       ntrain,
+                       ntest,
+                       1,
+                       x_train_generator,
+                       x_test_generator)
 
-    X = jnp.vstack([X_train, X_test])
-
-    poly = PolynomialFeatures(degree)
-    Phi = jnp.array(poly.fit_transform(X), dtype=jnp.float32)
+    # Expanded once on the train and test inputs together, splitting X first
+    # would run the expansion twice.
+    Phi = poly_features(X, degree)
 
     N = ntrain + ntest
     get_kernel = 'ntk' if ntk else 'nngp'
@@ -324,9 +412,8 @@ def make_random_poly_regression_environment(key: chex.PRNGKey,
     kernel_fn = make_linear_kernel(input_dim)
     kernel = kernel_fn(X, x2=None, get=get_kernel)
     kernel += kernel_ridge * jnp.eye(len(kernel))
-    mean = jnp.zeros((N,), dtype=jnp.float32)
-    y_function = random.multivariate_normal(y_key, mean, kernel)
-    print(y_function)
+    L = jnp.linalg.cholesky(kernel)
+    y_function = L @ random.normal(y_key, (N,))
     chex.assert_shape(y_function[:ntrain], [ntrain,])
 
     # Form the training data
@@ -350,10 +437,8 @@ def make_random_poly_regression_environment(key: chex.PRNGKey,
 
     if shuffle:
         train_key, test_key = random.split(key)
-        train_indices = random.permutation(train_key,
-                                           jnp.arange(ntrain))
-        test_indices = random.permutation(test_key,
-                                          jnp.arange(ntest))
+        train_indices = random.permutation(train_key, ntrain)
+        test_indices = random.permutation(test_key, ntest)
 
         X_train = X_train[train_indices]
         y_train = y_train[train_indices]
@@ -384,29 +469,33 @@ def make_random_linear_classification_environment(key: chex.PRNGKey,
                                                   test_batch_size: int = 1,
                                                   x_train_generator: Callable = random.normal,
                                                   x_test_generator: Callable = random.normal,
-                                                  shuffle: bool = False):
+                                                  shuffle: bool = False,
+                                                  dtype: Any = jnp.float32):
     # https://github.com/scikit-learn/scikit-learn/blob/7e1e6d09bcc2eaeba98f7e737aac2ac782f0e5f1/sklearn/datasets/_samples_generator.py#L506
 
     # Randomly generate a well conditioned input set
     train_key, test_key, w_key, noise_key, env_key = random.split(key, 5)
 
-    X_train = x_train_generator(train_key, (ntrain, nfeatures))
-    X_test = x_test_generator(test_key, (ntest, nfeatures))
-
-    ntrain = len(X_train)
-    ntest = len(X_test)
-
-    X = jnp.vstack([X_train, X_test])
+    X = _sample_inputs(train_key,
+                       test_key,
+                       ntrain,
+                       ntest,
+                       nfeatures,
+                       x_train_generator,
+                       x_test_generator)
 
     # Generate a ground truth model with only n_informative features being non
     # zeros (the other features are not correlated to y and should be ignored
     # by a sparsifying regularizers such as L1 or elastic net)
     w = 100 * random.normal(w_key, (nfeatures, ntargets))
-    logprobs = nn.log_softmax(jnp.dot(X, w) + bias, axis=-1)
-    Y = jnp.argmax(logprobs, axis=-1).reshape((-1, 1))
+    logits = _apply_in_dtype(lambda w, x: jnp.dot(x, w), w, X, dtype) + bias
+    # log_softmax is monotonic, so the labels come straight from the logits.
+    # The normalised log probabilities are only kept for the environment.
+    Y = jnp.argmax(logits, axis=-1).reshape((-1, 1))
+    logprobs = nn.log_softmax(logits, axis=-1)
 
     if bias:
-        X = jnp.hstack([jnp.ones((len(X), 1)), X])
+        X = jnp.pad(X, ((0, 0), (1, 0)), constant_values=1.)
 
     # Add noise
     if obs_noise > 0.0:
@@ -448,29 +537,30 @@ def make_random_linear_regression_environment(key: chex.PRNGKey,
                                               test_batch_size: int = 1,
                                               x_train_generator: Callable = random.normal,
                                               x_test_generator: Callable = random.normal,
-                                              shuffle: bool = False):
+                                              shuffle: bool = False,
+                                              dtype: Any = jnp.float32):
     # https://github.com/scikit-learn/scikit-learn/blob/7e1e6d09bcc2eaeba98f7e737aac2ac782f0e5f1/sklearn/datasets/_samples_generator.py#L506
 
     nsamples = ntrain + ntest
     # Randomly generate a well conditioned input set
     train_key, test_key, w_key, noise_key, env_key = random.split(key, 5)
 
-    X_train = x_train_generator(train_key, (ntrain, nfeatures))
-    X_test = x_test_generator(test_key, (ntest, nfeatures))
-
-    ntrain = len(X_train)
-    ntest = len(X_test)
-
-    X = jnp.vstack([X_train, X_test])
+    X = _sample_inputs(train_key,
+                       test_key,
+                       ntrain,
+                       ntest,
+                       nfeatures,
+                       x_train_generator,
+                       x_test_generator)
 
     # Generate a ground truth model with only n_informative features being non
     # zeros (the other features are not correlated to y and should be ignored
     # by a sparsifying regularizers such as L1 or elastic net)
     w = 100 * random.normal(w_key, (nfeatures, ntargets))
 
-    Y = jnp.dot(X, w) + bias
+    Y = _apply_in_dtype(lambda w, x: jnp.dot(x, w), w, X, dtype) + bias
     if bias:
-        X = jnp.hstack([jnp.ones((len(X), 1)), X])
+        X = jnp.pad(X, ((0, 0), (1, 0)), constant_values=1.)
 
     # Add noise
     if obs_noise > 0.0:
@@ -526,6 +616,17 @@ def make_mlp(key: chex.PRNGKey,
     return net_fn
 
 
+def _scale_output_layer(params: hk.Params,
+                        nhidden: int,
+                        scale: float) -> hk.Params:
+    # Haiku names the Linear modules of make_mlp linear, linear_1, ..., so the
+    # output layer is linear_{nhidden}. Scaling its weights and bias scales
+    # the logits without an extra pass over them.
+    output_layer = f"linear_{nhidden}"
+    return {name: tree_map(lambda p: p * scale, module) if name == output_layer else module
+            for name, module in params.items()}
+
+
 def make_classification_mlp_environment(key: chex.PRNGKey,
                                         nfeatures: int,
                                         ntargets: int,
@@ -537,7 +638,8 @@ def make_classification_mlp_environment(key: chex.PRNGKey,
                                         test_batch_size: int = 1,
                                         x_train_generator: Callable = random.normal,
                                         x_test_generator: Callable = random.normal,
-                                        shuffle: bool = False):
+                                        shuffle: bool = False,
+                                        dtype: Any = jnp.float32):
     train_key, test_key, y_key, env_key = random.split(key, 4)
     net_fn = make_mlp(y_key,
                       nfeatures,
@@ -551,33 +653,34 @@ def make_classification_mlp_environment(key: chex.PRNGKey,
     params = transformed.init(key, dummy_input)
 
     assert temperature > 0.0
+    params = _scale_output_layer(params, len(hidden_layer_sizes), 1. / temperature)
 
     def forward(x: chex.Array):
-        return transformed.apply(params, x) / temperature
+        return transformed.apply(params, x)
 
     y_predictor = jit(forward)
 
     # Generates training data for given problem
-    X_train = x_train_generator(train_key, (ntrain, nfeatures))
-    X_test = x_test_generator(test_key, (ntest, nfeatures))
-
-    ntrain = len(X_train)
-    ntest = len(X_test)
-
-    X = jnp.vstack([X_train, X_test])
-
-    # Generate environment function across x_train
-    train_logits = y_predictor(X)  # [n_train, n_class]
-    train_probs = nn.softmax(train_logits, axis=-1)
-
-    # Generate training data.
-    def sample_output(probs: chex.Array, key: chex.PRNGKey) -> chex.Array:
-        return random.choice(key, ntargets, shape=(1,), p=probs)
-
-    nsamples = ntrain + ntest
-    y_keys = random.split(y_key, nsamples)
-
-    Y = vmap(sample_output)(train_probs, y_keys)
+    X = _sample_inputs(train_key,
+                       test_key,
+                       ntrain,
+                       ntest,
+                       nfeatures,
+                       x_train_generator,
+                       x_test_generator)
+
+    # The forward pass, softmax and sampling are compiled together so the
+    # probabilities are never materialised on their own.
+    @jit
+    def generate(X: chex.Array, key: chex.PRNGKey):
+        logits = _apply_in_dtype(transformed.apply, params, X, dtype)  # [n_train, n_class]
+        probs = nn.softmax(logits, axis=-1)
+        indices = jnp.arange(len(X))
+        Y = lax.map(lambda args: _sample_categorical(args[0], random.fold_in(key, args[1]), ntargets),
+                    (probs, indices))
+        return logits, Y
+
+    train_logits, Y = generate(X, y_key)
 
     X_train = X[:ntrain]
     X_test = X[ntrain:]
@@ -618,7 +721,8 @@ def make_regression_mlp_environment(key: chex.PRNGKey,
                                     test_batch_size: int = 1,
                                     x_train_generator: Callable = random.normal,
                                     x_test_generator: Callable = random.normal,
-                                    shuffle: bool = False):
+                                    shuffle: bool = False,
+                                    dtype: Any = jnp.float32):
     train_key, test_key, y_key, env_key = random.split(key, 4)
     net_fn = make_mlp(y_key,
                       nfeatures,
@@ -632,22 +736,24 @@ def make_regression_mlp_environment(key: chex.PRNGKey,
     params = transformed.init(key, dummy_input)
 
     assert temperature > 0.0
+    params = _scale_output_layer(params, len(hidden_layer_sizes), 1. / temperature)
 
     def forward(x: chex.Array):
-        return transformed.apply(params, x) / temperature
+        return transformed.apply(params, x)
 
     y_predictor = jit(forward)
 
     # Generates training data for given problem
-    X_train = x_train_generator(train_key, (ntrain, nfeatures))
-    X_test = x_test_generator(test_key, (ntest, nfeatures))
-
-    ntrain = len(X_train)
-
-    X = jnp.vstack([X_train, X_test])
+    X = _sample_inputs(train_key,
+                       test_key,
+                       ntrain,
+                       ntest,
+                       nfeatures,
+                       x_train_generator,
+                       x_test_generator)
 
     # Generate environment function across x_train
-    Y = y_predictor(X)  # [n_train, output_dim]
+    Y = _apply_in_dtype(transformed.apply, params, X, dtype)  # [n_train, output_dim]
 
     X_train = X[:ntrain]
     X_test = X[ntrain:]
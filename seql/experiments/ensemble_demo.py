@@ -138,11 +138,11 @@ if __name__ == "__main__":
 
     nsteps = 10
 
-    belief_state, rewards = train(initial_belief_state,
-                                  agent,
-                                  env,
-                                  nsteps,
-                                  callback=None)
+    belief_state = train(initial_belief_state,
+                         agent,
+                         env,
+                         nsteps,
+                         callback=None)
 
     X_train = env.X_train.reshape((ntrain, -1))
     y_train = env.y_train.reshape((ntrain, -1))
@@ -3,6 +3,8 @@ Models and functions that are used for experiments.
 '''
 from jax import random
 
+from functools import partial
+
 import flax.linen as nn
 
 import matplotlib.pyplot as plt
@@ -91,6 +93,55 @@ def get_fig_and_axes(nrows, ncols, figsize):
     return fig, axes
 
 
+def _train_agent(key: chex.PRNGKey,
+                 agent_name: str,
+                 agent: Agent,
+                 batch_agent: Agent,
+                 train_env: SequentialDataEnvironment,
+                 batch_env: SequentialDataEnvironment,
+                 initialize_params: Callable,
+                 nsteps: int,
+                 nsamples_input: int,
+                 nsamples_output: int,
+                 njoint: int,
+                 callback_fn: Callable,
+                 **callback_kwargs):
+
+    def agent_callback(**kwargs):
+        callback_fn(agent_name=agent_name, **callback_kwargs, **kwargs)
+
+    params = initialize_params(agent_name, **callback_kwargs)
+    belief = agent.init_state(*params)
+
+    train_key, batch_key = random.split(key)
+    train(train_key,
+          belief,
+          agent,
+          train_env,
+          nsamples_input=nsamples_input,
+          nsamples_output=nsamples_output,
+          njoint=njoint,
+          nsteps=nsteps,
+          callback=agent_callback)
+
+    if batch_agent is not None:
+        ncols, idx = callback_kwargs["ncols"], callback_kwargs["idx"]
+        # An agent built with donate_belief may have donated the buffers of
+        # its initial belief, so the batch agent starts from its own.
+        belief = batch_agent.init_state(*params)
+        train(batch_key,
+              belief,
+              batch_agent,
+              batch_env,
+              nsamples_input=nsamples_input,
+              nsamples_output=nsamples_output,
+              njoint=njoint,
+              nsteps=1,
+              callback=partial(agent_callback,
+                               title="Batch Agent",
+                               subplot_idx=(idx + 1) * ncols))
+
+
 def run_experiment(key: chex.PRNGKey,
                    agents: List[Agent],
                    env: SequentialDataEnvironment,
@@ -105,59 +156,49 @@ def run_experiment(key: chex.PRNGKey,
                    ncols: int,
                    callback_fn: Callable,
                    figsize: Tuple[int, int] = (56, 48),
+                   preallocate_axes: bool = False,
                    **init_kwargs):
     batch_agents_included = "batch_agents" in init_kwargs
     fig, big_axes = get_fig_and_axes(nrows, ncols, figsize)
 
+    # Callbacks drawing one cell per timestep get their row of the grid as
+    # "axes" instead of creating a new subplot on every call.
+    if preallocate_axes:
+        axes = fig.subplots(nrows, ncols, squeeze=False)
+
+    # The environments are deterministic given their key, so each one is
+    # built once and shared by every agent.
+    train_env = env(train_batch_size)
+    batch_env = env(ntrain) if batch_agents_included else None
+
+    keys = random.split(key, len(agents))
+
     for idx, (big_ax, (agent_name, agent)) in enumerate(zip(big_axes, agents.items())):
         big_ax.set_title(agent_name.upper(), fontsize=36, y=1.2)
 
         if nrows != 1:
             set_ax_properties(big_ax)
 
-        params = initialize_params(agent_name, **init_kwargs)
-        belief = agent.init_state(*params)
-
-        partial_callback = lambda **kwargs: callback_fn(
-                                                        agent_name=agent_name,
-                                                        fig=fig,
-                                                        nrows=nrows,
-                                                        ncols=ncols,
-                                                        idx=idx,
-                                                        **init_kwargs,
-                                                        **kwargs)
-
-        train_key, key = random.split(key)
-        train(train_key,
-              belief,
-              agent,
-              env(train_batch_size),
-                  nsamples_input=nsamples_input,
-                  nsamples_output=nsamples_output,
-                                njoint=njoint,
-              nsteps=nsteps,
-              callback=partial_callback)
-
-        if batch_agents_included:
-            batch_agent = init_kwargs["batch_agents"][agent_name]
-            partial_callback = lambda **kwargs: callback_fn(
-                                                            agent_name=agent_name,
-                                                            fig=fig,
-                                                            nrows=nrows,
-                                                            ncols=ncols,
-                                                            idx=idx,
-                                                            title="Batch Agent",
-                                                            subplot_idx=(idx + 1) * ncols,
-                                                            **init_kwargs,
-                                                            **kwargs)
-
-            train_key, key = random.split(key)
-            train(train_key,
-                  belief,
-                  batch_agent,
-                  env(ntrain),
-                  nsamples_input=nsamples_input,
-                  nsamples_output=nsamples_output,
-                  njoint=njoint,
-                  nsteps=1,
-                  callback=partial_callback)
\ No newline at end of file
+        row_axes = {"axes": axes[idx]} if preallocate_axes else {}
+        batch_agent = init_kwargs["batch_agents"][agent_name] if batch_agents_included else None
+
+        _train_agent(keys[idx],
+                     agent_name,
+                     agent,
+                     batch_agent,
+                     train_env,
+                     batch_env,
+                     initialize_params,
+                     nsteps,
+                     nsamples_input,
+                     nsamples_output,
+                     njoint,
+                     callback_fn,
+                     fig=fig,
+                     nrows=nrows,
+                     ncols=ncols,
+                     idx=idx,
+                     **row_axes,
+                     **init_kwargs)
+
+    return fig
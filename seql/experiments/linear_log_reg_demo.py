@@ -65,9 +65,7 @@ def callback_fn(agent, env, agent_name, **kwargs):
     else:
         subplot_idx = kwargs["subplot_idx"]
 
-    ax = kwargs["fig"].add_subplot(kwargs["nrows"],
-                                   kwargs["ncols"],
-                                   subplot_idx)
+    ax = kwargs["axes"][(subplot_idx - 1) % kwargs["ncols"]]
 
     belief = kwargs["belief"]
 
@@ -101,10 +99,6 @@ def callback_fn(agent, env, agent_name, **kwargs):
         w = agent.sample_params(random.PRNGKey(i*42), belief)   
         pred = model_fn(w.reshape((2,2)), grid)
         ax.contour(xx, yy, pred[:, 0].reshape((n, n)), jnp.array([0.5]))
-    
-
-    plt.tight_layout()
-    plt.savefig("jakjs.png")
 
 
 def initialize_params(agent_name, **kwargs):
@@ -278,7 +272,11 @@ def main():
                    batch_agents=batch_agents,
                    timesteps=timesteps,
                    degree=degree,
-                   nclasses=nclasses)
+                   nclasses=nclasses,
+                   preallocate_axes=True)
+
+    plt.tight_layout()
+    plt.savefig("jakjs.png")
 
 
 if __name__ == "__main__":
@@ -42,9 +42,9 @@ def main():
     belief = kf_agent.init_state(mu0, Sigma0)
 
     nsteps = 100
-    _, unused_rewards = train(belief, kf_agent, env,
-                                nsteps=nsteps,
-                                callback=callback_fn)
+    train(belief, kf_agent, env,
+          nsteps=nsteps,
+          callback=callback_fn)
                  
 
     
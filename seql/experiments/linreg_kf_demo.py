@@ -94,7 +94,7 @@ def main():
     belief = agent.init_state(mu0, Sigma0)
 
     callback_fns = [save_history, plot_ppd]
-    belief, unused_rewards = train(belief, agent, env, nsteps=nsteps, callback=callback_fns)
+    belief = train(belief, agent, env, nsteps=nsteps, callback=callback_fns)
 
     w0_hist, w1_hist = mu_hist.T
     w0_err, w1_err = jnp.sqrt(sigma_hist[:, [0, 1], [0, 1]].T)
@@ -83,8 +83,8 @@ def main():
     nlds = NLDS(fz, fx, Pt, Rt, mu_t, P0)
     agent = eekf(nlds, return_history=True)
     belief = agent.init_state(mu_t, P0)
-    belief, unused_rewards = train(belief, agent, env,
-                                   n_datapoints, callback_fn)
+    belief = train(belief, agent, env,
+                   n_datapoints, callback_fn)
 
     w_eekf_hist = mu_hist
     P_eekf_hist = sigma_hist
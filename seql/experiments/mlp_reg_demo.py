@@ -3,12 +3,13 @@ import jax.numpy as jnp
 from jax import random, jit, vmap
 
 import optax
+from functools import lru_cache, partial
 import haiku as hk
 from flax.core import frozen_dict
 from matplotlib import pyplot as plt
 
 from seql.agents.bfgs_agent import BFGSAgent
-from seql.agents.blackjax_nuts_agent import BlackJaxNutsAgent
+from seql.agents.numpyro_nuts_agent import NumpyroNutsAgent
 from seql.agents.ensemble_agent import EnsembleAgent
 from seql.agents.sgd_agent import SGDAgent
 from seql.agents.sgmcmc_sgld_agent import SGLDAgent
@@ -28,39 +29,26 @@ def logprior_fn(params):
 def loglikelihood_fn(params, x, y, model_fn):
     return -mean_squared_error(params, x, y, model_fn)
 
-losses = []
-subplot_idx = 1
-i = 0
+@partial(jit, static_argnames=("model_fn",))
+def _eval(model_fn, thetas, inputs, outputs):
+    preds = vmap(model_fn, in_axes=(0, None))(thetas, inputs)
+    preds = jnp.mean(preds, axis=0)
+    return jnp.mean(jnp.power(preds - outputs, 2))
+
 
 def callback_fn(agent, env, agent_name, **kwargs):
-    global losses, subplot_idx
     t = kwargs["t"]
-    if kwargs["t"] == 0:
-        losses = []
     belief = kwargs["belief"]
-    nfeatures = kwargs["nfeatures"]
-    out = 1
-
-    inputs = env.X_test.reshape((-1, nfeatures))
-    outputs = env.y_test.reshape((-1, out))
-    theta = agent.sample_params(random.PRNGKey(t*42), belief)
-    preds = model_fn(theta, inputs)
-    loss = jnp.mean(jnp.power(preds - outputs, 2))
-    
-    losses.append(loss)
-    fig = kwargs["fig"]
-    nrows, ncols  = kwargs["nrows"], kwargs["ncols"]
-
-    if kwargs["t"] == 9:
-        ax = fig.add_subplot(nrows,
-                         ncols,
-                         subplot_idx)
-        subplot_idx += 1
-        ax.plot(losses, color=colors[agent_name])
-        ax.set_title(agent_name.upper())
-        plt.tight_layout()
-        plt.savefig("asas.png")
-        losses = []
+    inputs, outputs = kwargs["X_test"], kwargs["y_test"]
+    if agent_name == "ensemble":
+        # All members are evaluated in one batched forward pass.
+        thetas = belief.params
+    else:
+        thetas = agent.sample_many_params(kwargs["sample_keys"][t], belief, kwargs["nsamples"])
+    loss = _eval(agent.model_fn, thetas, inputs, outputs)
+
+    # Losses stay on device; the curves are drawn once all agents are trained.
+    kwargs["losses"][agent_name].append(loss)
 
 
 def initialize_params(agent_name, **kwargs):
@@ -73,10 +61,9 @@ def initialize_params(agent_name, **kwargs):
         params = transformed.init(key, dummy_input)
         return params
     if agent_name == "ensemble":
-        keys = random.split(key, 8)
-        trainable = vmap(get_params)(keys)
-        keys = random.split(random.PRNGKey(9), 8)
-        baseline = trainable = vmap(get_params)(keys)
+        baseline_key, trainable_key = random.split(key)
+        baseline = vmap(get_params)(random.split(baseline_key, 8))
+        trainable = vmap(get_params)(random.split(trainable_key, 8))
         params = frozen_dict.freeze(
             {"params": {"baseline": baseline,
                         "trainable": trainable
@@ -91,7 +78,7 @@ def initialize_params(agent_name, **kwargs):
 def main():
     global model_fn
     key = random.PRNGKey(0)
-    model_key, env_key, init_key, run_key = random.split(key, 4)
+    model_key, env_key, init_key, run_key, sample_key = random.split(key, 5)
     ntrain = 20
     ntest = 20
     batch_size = 2
@@ -116,18 +103,31 @@ def main():
 
     model_fn = jit(forward)
 
-    env = lambda batch_size: make_regression_mlp_environment(env_key,
-                                                             nfeatures,
-                                                             ntargets,
-                                                             ntrain,
-                                                             ntest,
-                                                             temperature=1.,
-                                                             hidden_layer_sizes=hidden_layer_sizes,
-                                                             train_batch_size=batch_size,
-                                                             test_batch_size=batch_size,
-                                                             )
+    # Compiles the forward pass for the input shapes used outside the agents
+    # so the trace is not charged to the first timestep.
+    dummy_params = transformed.init(init_key, jnp.zeros((1, nfeatures)))
+    for n in {batch_size, ntrain, ntest}:
+        model_fn(dummy_params, jnp.zeros((n, nfeatures))).block_until_ready()
+
+    env = lru_cache(lambda batch_size: make_regression_mlp_environment(env_key,
+                                                                       nfeatures,
+                                                                       ntargets,
+                                                                       ntrain,
+                                                                       ntest,
+                                                                       temperature=1.,
+                                                                       hidden_layer_sizes=hidden_layer_sizes,
+                                                                       train_batch_size=batch_size,
+                                                                       test_batch_size=batch_size,
+                                                                       ))
+
+    # The test set does not change over the run, it is flattened once and
+    # kept on device for the callbacks.
+    test_env = env(batch_size)
+    X_test = test_env.X_test.reshape((-1, nfeatures)).block_until_ready()
+    y_test = test_env.y_test.reshape((-1, ntargets)).block_until_ready()
 
     nsteps = 10
+    sample_keys = random.split(sample_key, nsteps)
 
     buffer_size = ntrain
 
@@ -142,9 +142,17 @@ def main():
                    nepochs=nepochs,
                    buffer_size=buffer_size)
 
+    # The epochs already run inside one lax.scan, compiled for the full
+    # buffer here so the trace is not charged to the timestep that fills it.
+    warmup_belief = sgd.init_state(dummy_params)
+    sgd.train_fn(warmup_belief.params,
+                 warmup_belief.opt_state,
+                 jnp.zeros((buffer_size, nfeatures)),
+                 jnp.zeros((buffer_size, ntargets)),
+                 nepochs=nepochs)
 
     nsamples, nwarmup = 500, 200
-    nuts = BlackJaxNutsAgent(
+    nuts = NumpyroNutsAgent(
         loglikelihood_fn,
         model_fn,
         logprior=logprior_fn,
@@ -202,7 +210,9 @@ def main():
     nsamples_output = 10
     njoint = 10
 
-    run_experiment(run_key,
+    losses = {agent_name: [] for agent_name in agents}
+
+    fig = run_experiment(run_key,
                    agents,
                    env,
                    initialize_params,
@@ -218,7 +228,22 @@ def main():
                    obs_noise=obs_noise,
                    timesteps=list(range(nsteps)),
                    nfeatures=nfeatures,
-                   transformed=transformed)
+                   transformed=transformed,
+                   nsamples=nsamples_output,
+                   sample_keys=sample_keys,
+                   X_test=X_test,
+                   y_test=y_test,
+                   losses=losses)
+
+    for subplot_idx, (agent_name, agent_losses) in enumerate(losses.items(), 1):
+        ax = fig.add_subplot(nrows,
+                             ncols,
+                             subplot_idx)
+        ax.plot(jnp.stack(agent_losses), color=colors[agent_name])
+        ax.set_title(agent_name.upper())
+
+    plt.tight_layout()
+    plt.savefig("asas.png")
 
 
 if __name__ == "__main__":
@@ -1,18 +1,21 @@
 import jax.numpy as jnp
-from jax import random, tree_leaves, tree_map
+from jax import jit, random, vmap
+from jax.flatten_util import ravel_pytree
 from jax import nn
 
+import numpy as np
 from matplotlib import pyplot as plt
+from matplotlib.colors import ListedColormap
 import optax
-from sklearn.preprocessing import PolynomialFeatures
+from functools import lru_cache, partial
 
 from seql.agents.eekf_agent import EEKFAgent
 from seql.agents.bfgs_agent import BFGSAgent
-from seql.agents.blackjax_nuts_agent import BlackJaxNutsAgent
+from seql.agents.numpyro_nuts_agent import NumpyroNutsAgent
 from seql.agents.lbfgs_agent import LBFGSAgent
 from seql.agents.sgd_agent import SGDAgent
 from seql.agents.sgmcmc_sgld_agent import SGLDAgent
-from seql.environments.base import make_random_poly_classification_environment
+from seql.environments.base import make_random_poly_classification_environment, poly_features
 from seql.experiments.experiment_utils import run_experiment
 from seql.experiments.plotting import sort_data
 from seql.utils import cross_entropy_loss
@@ -27,9 +30,10 @@ def model_fn(w, x):
     return nn.softmax(x @ w, axis=-1)
 
 
+@jit
 def logprior_fn(params, strength=0.2):
-    leaves = tree_leaves(params)
-    return -sum(tree_map(lambda x: jnp.sum(x ** 2), leaves)) * strength
+    flat_params, _ = ravel_pytree(params)
+    return -jnp.sum(flat_params ** 2) * strength
 
 
 def loglikelihood_fn(params, x, y, model_fn):
@@ -37,12 +41,17 @@ def loglikelihood_fn(params, x, y, model_fn):
     return -cross_entropy_loss(y, logprobs)
 
 
+@jit
+def accuracy(logprobs, ytest):
+    predictions = jnp.argmax(logprobs, axis=-1)
+    return jnp.mean(predictions == jnp.squeeze(ytest))
+
+
 def print_accuracy(logprobs, ytest):
-    ytest_ = jnp.squeeze(ytest)
-    predictions = jnp.where(logprobs > jnp.log(0.5), 1, 0)
-    print("Accuracy: ", jnp.mean(jnp.argmax(predictions, axis=-1) == ytest_))
+    print("Accuracy: ", float(accuracy(logprobs, ytest)))
 
-def get_grid(min_x, max_x, min_y, max_y):
+@partial(jit, static_argnames=("min_x", "max_x", "min_y", "max_y", "degree"))
+def get_grid(min_x, max_x, min_y, max_y, degree):
     # define the x and y scale
     x1grid = jnp.arange(min_x, max_x, 0.1)
     x2grid = jnp.arange(min_y, max_y, 0.1)
@@ -50,12 +59,20 @@ def get_grid(min_x, max_x, min_y, max_y):
     # create all of the lines and rows of the grid
     xx, yy = jnp.meshgrid(x1grid, x2grid)
 
-    # flatten each grid to a vector
-    r1, r2 = xx.flatten(), yy.flatten()
-    r1, r2 = r1.reshape((len(r1), 1)), r2.reshape((len(r2), 1))
-    # horizontal stack vectors to create x1,x2 input for the model
-    grid = jnp.hstack((r1, r2))
-    return xx, yy, grid
+    # pair up the grid points to create x1,x2 input for the model
+    grid = jnp.stack((xx, yy), axis=-1).reshape((-1, 2))
+    # Expands the grid into the same monomials the environment was built with
+    return xx, yy, poly_features(grid, degree)
+
+
+@partial(jit, static_argnames=("agent", "nsamples"))
+def posterior_predictive_probs(key, agent, belief, x, nsamples):
+    # model_fn already returns class probabilities, so their average over the
+    # parameter samples is the posterior predictive without sampling labels.
+    thetas = agent.sample_many_params(key, belief, nsamples)
+    probs = vmap(agent.model_fn, in_axes=(0, None))(thetas, x)
+    return jnp.mean(probs, axis=0)
+
 
 def callback_fn(agent, env, agent_name, **kwargs):
     if "subplot_idx" not in kwargs and kwargs["t"] not in kwargs["timesteps"]:
@@ -65,23 +82,16 @@ def callback_fn(agent, env, agent_name, **kwargs):
     else:
         subplot_idx = kwargs["subplot_idx"]
 
-    ax = kwargs["fig"].add_subplot(kwargs["nrows"],
-                                   kwargs["ncols"],
-                                   subplot_idx)
+    ax = kwargs["axes"][(subplot_idx - 1) % kwargs["ncols"]]
 
     belief = kwargs["belief"]
+    x, y, grid = kwargs["grid"]
 
-    
-    min_x, max_x = -3, 3
-    min_y, max_y = -3, 3
-    x, y, grid = get_grid(min_x, max_x, min_y, max_y)
-
-    poly = PolynomialFeatures(kwargs["degree"])
-    grid_preds = agent.posterior_predictive_mean(random.PRNGKey(0),
-                                    belief,
-                                    poly.fit_transform(grid),
-                                    200,
-                                    100)
+    grid_preds = posterior_predictive_probs(kwargs["sample_keys"][kwargs["t"]],
+                                            agent,
+                                            belief,
+                                            grid,
+                                            200)
 
     # keep just the probabilities for class 1
     grid_preds = grid_preds[:, 1]
@@ -99,18 +109,17 @@ def callback_fn(agent, env, agent_name, **kwargs):
 
     t = kwargs["t"]
 
-    x, y = sort_data(env.X_test[:t + 1], env.y_test[:t + 1])
-    colors = ["#86bbd8", "#E39191"]
-    for cls, color in enumerate(colors):
-        indices = jnp.argwhere(y == cls)
-        # Plot training data
-        ax.scatter(x[indices, 1],
-                   x[indices, 2],
-                   s=240.,
-                   c=color,
-                   edgecolor="black")
-    plt.tight_layout()
-    plt.savefig("jakjs.png")
+    x, y, _ = sort_data(env.X_test[:t + 1], env.y_test[:t + 1])
+    # Plot training data, colored by class in a single draw call
+    cmap = ListedColormap(["#86bbd8", "#E39191"])
+    ax.scatter(np.asarray(x[:, 1]),
+               np.asarray(x[:, 2]),
+               s=240.,
+               c=np.asarray(jnp.squeeze(y, axis=-1)),
+               cmap=cmap,
+               vmin=0,
+               vmax=1,
+               edgecolor="black")
 
 
 def initialize_params(agent_name, **kwargs):
@@ -139,18 +148,23 @@ def main():
     nsteps = 10
     nfeatures, nclasses = 2, 2
 
-    env_key, experiment_key = random.split(key, 2)
+    env_key, experiment_key, sample_key = random.split(key, 3)
     obs_noise = 0.
-    env = lambda batch_size: make_random_poly_classification_environment(env_key,
-                                                                         degree,
-                                                                         ntrain,
-                                                                         ntest,
-                                                                         nfeatures=nfeatures,
-                                                                         nclasses=nclasses,
-                                                                         obs_noise=obs_noise,
-                                                                         train_batch_size=batch_size,
-                                                                         test_batch_size=batch_size,
-                                                                         shuffle=False)
+    # Built once per batch size, the builder also returns the prior knowledge
+    # which the experiment does not use.
+    @lru_cache
+    def env(batch_size):
+        _, seq_env = make_random_poly_classification_environment(env_key,
+                                                                 degree,
+                                                                 ntrain,
+                                                                 ntest,
+                                                                 nfeatures=nfeatures,
+                                                                 nclasses=nclasses,
+                                                                 obs_noise=obs_noise,
+                                                                 train_batch_size=batch_size,
+                                                                 test_batch_size=batch_size,
+                                                                 shuffle=False)
+        return seq_env
 
     buffer_size = ntrain
 
@@ -200,7 +214,7 @@ def main():
 
     nsamples, nwarmup = 500, 300
 
-    nuts = BlackJaxNutsAgent(loglikelihood_fn,
+    nuts = NumpyroNutsAgent(loglikelihood_fn,
     model_fn,
     nsamples,
     nwarmup,
@@ -208,7 +222,7 @@ def main():
     obs_noise=obs_noise,
     buffer_size=buffer_size,
     is_classifier=is_classifier)
-    batch_nuts = BlackJaxNutsAgent(loglikelihood_fn,
+    batch_nuts = NumpyroNutsAgent(loglikelihood_fn,
     model_fn,
     nsamples * nsteps,
     nwarmup,
@@ -266,6 +280,17 @@ def main():
     ncols = len(timesteps)
     njoint = 10
     nsamples_input, nsamples_output = 1, 1
+
+    # The grid only depends on the plotting extents and the degree, so it is
+    # expanded once and shared by every callback. The extents cover the raw
+    # inputs, columns 1 and 2 of the features, of the train and test sets.
+    data_env = env(batch_size)
+    X = jnp.vstack([data_env.X_train.reshape((-1, input_dim)), data_env.X_test])
+    bounds = jnp.stack([jnp.floor(X[:, 1:3].min(axis=0)),
+                        jnp.ceil(X[:, 1:3].max(axis=0))])
+    (min_x, min_y), (max_x, max_y) = bounds.tolist()
+    grid = get_grid(min_x, max_x, min_y, max_y, degree)
+
     run_experiment(experiment_key,
                    agents,
                    env,
@@ -283,8 +308,14 @@ def main():
                    obs_noise=obs_noise,
                    batch_agents=batch_agents,
                    timesteps=timesteps,
+                   sample_keys=random.split(sample_key, nsteps),
                    degree=degree,
-                   nclasses=nclasses)
+                   nclasses=nclasses,
+                   grid=grid,
+                   preallocate_axes=True)
+
+    plt.tight_layout()
+    plt.savefig("jakjs.png")
 
 
 if __name__ == "__main__":
@@ -4,7 +4,6 @@ from jax import nn
 
 from matplotlib import pyplot as plt
 import optax
-from sklearn.preprocessing import PolynomialFeatures
 
 from seql.agents.eekf_agent import EEKFAgent
 from seql.agents.bfgs_agent import BFGSAgent
@@ -12,7 +11,7 @@ from seql.agents.blackjax_nuts_agent import BlackJaxNutsAgent
 from seql.agents.lbfgs_agent import LBFGSAgent
 from seql.agents.sgd_agent import SGDAgent
 from seql.agents.sgmcmc_sgld_agent import SGLDAgent
-from seql.environments.base import make_random_poly_classification_environment
+from seql.environments.base import make_random_poly_classification_environment, poly_features
 from seql.experiments.experiment_utils import run_experiment
 from seql.experiments.plotting import sort_data
 from seql.utils import cross_entropy_loss
@@ -65,9 +64,7 @@ def callback_fn(agent, env, agent_name, **kwargs):
     else:
         subplot_idx = kwargs["subplot_idx"]
 
-    ax = kwargs["fig"].add_subplot(kwargs["nrows"],
-                                   kwargs["ncols"],
-                                   subplot_idx)
+    ax = kwargs["axes"][(subplot_idx - 1) % kwargs["ncols"]]
 
     belief = kwargs["belief"]
 
@@ -76,8 +73,6 @@ def callback_fn(agent, env, agent_name, **kwargs):
     min_y, max_y = -3, 3
     xx, yy, grid = get_grid(min_x, max_x, min_y, max_y)
 
-    poly = PolynomialFeatures(kwargs["degree"])
-
     
     if "title" in kwargs:
         ax.set_title(kwargs["title"], fontsize=32)
@@ -98,16 +93,12 @@ def callback_fn(agent, env, agent_name, **kwargs):
                    edgecolor="black")
     n = xx.shape[0]
     
-    x = poly.fit_transform(grid)
+    x = poly_features(grid, kwargs["degree"])
     
     for i in range(10):
         w = agent.sample_params(random.PRNGKey(i*42), belief)        
         pred = model_fn(w.reshape((10,2)), x)
         ax.contour(xx, yy, pred[:, 0].reshape((n, n)), jnp.array([0.5]))
-    
-
-    plt.tight_layout()
-    plt.savefig("jakjs.png")
 
 
 def initialize_params(agent_name, **kwargs):
@@ -284,7 +275,11 @@ def main():
                    batch_agents=batch_agents,
                    timesteps=timesteps,
                    degree=degree,
-                   nclasses=nclasses)
+                   nclasses=nclasses,
+                   preallocate_axes=True)
+
+    plt.tight_layout()
+    plt.savefig("jakjs.png")
 
 
 if __name__ == "__main__":
@@ -6,7 +6,6 @@ from jax import random, tree_leaves, tree_map, vmap
 from jax import nn
 
 import optax
-from sklearn.preprocessing import PolynomialFeatures
 
 from seql.agents.eekf_agent import EEKFAgent
 from seql.agents.bfgs_agent import BFGSAgent
@@ -14,7 +13,7 @@ from seql.agents.blackjax_nuts_agent import BlackJaxNutsAgent
 from seql.agents.lbfgs_agent import LBFGSAgent
 from seql.agents.sgd_agent import SGDAgent
 from seql.agents.sgmcmc_sgld_agent import SGLDAgent
-from seql.environments.base import make_random_poly_classification_environment
+from seql.environments.base import make_random_poly_classification_environment, poly_features
 from seql.experiments.experiment_utils import run_experiment
 from seql.experiments.plotting import sort_data
 from seql.metrics.dyadic_sampling import make_nll_polyadic_calculator
@@ -81,8 +80,7 @@ def callback_fn(agent, env, agent_name, **kwargs):
     min_y, max_y = -3, 3
     x, y, grid = get_grid(min_x, max_x, min_y, max_y)
 
-    poly = PolynomialFeatures(kwargs["degree"])
-    phi = poly.fit_transform(grid)
+    phi = poly_features(grid, kwargs["degree"])
     def sample_fn(key, x):
         theta = agent.sample_params(key, belief)
         return model_fn(theta.reshape((10, -1)), x)
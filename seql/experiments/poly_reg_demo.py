@@ -1,17 +1,19 @@
 import jax.numpy as jnp
-from jax import random, nn, tree_map
+from jax import jit, random, nn, tree_map
+from jax.flatten_util import ravel_pytree
+import numpy as np
 from numpy import indices, kaiser
 
 import optax
+from functools import partial
 from jaxopt import ScipyMinimize
 from flax.core import frozen_dict
 from matplotlib import pyplot as plt
-from sklearn.preprocessing import PolynomialFeatures
 from seql.agents.base import Agent
 
 from seql.agents.bayesian_lin_reg_agent import BayesianReg
 from seql.agents.bfgs_agent import BFGSAgent
-from seql.agents.blackjax_nuts_agent import BlackJaxNutsAgent
+from seql.agents.numpyro_nuts_agent import NumpyroNutsAgent
 from seql.agents.ensemble_agent import EnsembleAgent
 from seql.agents.kf_agent import KalmanFilterRegAgent
 from seql.agents.laplace_agent import LaplaceAgent
@@ -31,14 +33,33 @@ plt.style.use("seaborn-poster")
 def model_fn(w, x):
     return x @ w
 
-def logprior_fn(params):
-    strength = 0.
-    return strength * jnp.sum(params ** 2)
 
+def make_logprior_fn(strength):
+    if strength == 0.:
+        # Without a prior there is nothing to trace into the agents' gradients.
+        return lambda params: jnp.zeros(())
+
+    @jit
+    def logprior_fn(params):
+        flat_params, _ = ravel_pytree(params)
+        return strength * jnp.vdot(flat_params, flat_params)
+
+    return logprior_fn
+
+
+@partial(jit, static_argnames=("model_fn",))
 def loglikelihood_fn(params, x, y, model_fn):
     return -mean_squared_error(params, x, y, model_fn)
 
 
+@partial(jit, static_argnames=("agent", "nsamples_params", "nsamples_output"))
+def posterior_predictive_mean_and_var(key, agent, belief, x, nsamples_params, nsamples_output):
+    # Compiled once per agent and sample counts instead of dispatching the
+    # Monte Carlo estimate op by op on every plotted step.
+    return agent.posterior_predictive_mean_and_var(key, belief, x,
+                                                   nsamples_params, nsamples_output)
+
+
 def callback_fn(**kwargs):
 
     agent, env = kwargs["agent"], kwargs["env"]
@@ -56,32 +77,25 @@ def callback_fn(**kwargs):
     else:
         subplot_idx = kwargs["subplot_idx"]
 
-    fig = kwargs["fig"]
-
-    '''if subplot_idx % ncols != 1:
-        ax = fig.add_subplot(nrows,
-                             ncols,
-                             subplot_idx,
-                             sharey=plt.gca(),
-                             sharex=plt.gca())
-    else:'''
-    ax = fig.add_subplot(nrows,
-                         ncols,
-                         subplot_idx)
+    ax = kwargs["axes"][(subplot_idx - 1) % ncols]
     belief = kwargs["belief"]
 
     
-    X_test, y_test, _ = sort_data(env.X_train[:t+1],
-                                   env.y_train[:t+1])
-
-    outs = agent.posterior_predictive_mean_and_var(random.PRNGKey(0),
-                                                   belief,
-                                                   X_test,
-                                                   200,
-                                                   100)
+    # matplotlib needs host arrays, so the data seen so far is copied once.
+    X_seen = np.asarray(env.X_train[:t+1])
+    y_seen = np.asarray(env.y_train[:t+1])
+
+    X_test, y_test, _ = sort_data(X_seen, y_seen)
+
+    outs = posterior_predictive_mean_and_var(kwargs["sample_keys"][t],
+                                             agent,
+                                             belief,
+                                             X_test,
+                                             200,
+                                             100)
     plot_regression_posterior_predictive(ax,
-                                         env.X_train[:t+1],
-                                         env.y_train[:t+1],
+                                         X_seen,
+                                         y_seen,
                                          X_test[:, 1],
                                          outs,
                                          agent_name,
@@ -91,10 +105,6 @@ def callback_fn(**kwargs):
     else:
         ax.set_title("t={}".format(t), fontsize=32)
 
-    plt.tight_layout()
-    plt.savefig("jaks.png")
-    plt.show()
-
 
 def initialize_params(agent_name, **kwargs):
     nfeatures = kwargs["degree"] + 1
@@ -104,9 +114,12 @@ def initialize_params(agent_name, **kwargs):
         Sigma0 = jnp.eye(nfeatures)
         initial_params = (mu0, Sigma0)
     elif agent_name =="ensemble":
+        # Members are stacked on the leading axis, which EnsembleAgent vmaps
+        # over for the forward pass, the gradients and the optimizer state.
+        nensemble = kwargs["nensemble"]
         initializer = random.normal
-        trainable = initializer(random.PRNGKey(0), (8,  nfeatures, 1)) * 2.
-        baseline = initializer(random.PRNGKey(2), (8,  nfeatures, 1)) * 2.
+        trainable = initializer(random.PRNGKey(0), (nensemble,  nfeatures, 1)) * 2.
+        baseline = initializer(random.PRNGKey(2), (nensemble,  nfeatures, 1)) * 2.
         initial_params = (frozen_dict.freeze(
                     {"params": {"baseline": baseline,
                                 "trainable": trainable
@@ -136,8 +149,11 @@ def main():
     ntest = 12
     batch_size = 3
     obs_noise = 0.1
+    strength = 0.
+
+    logprior_fn = make_logprior_fn(strength)
 
-    env_key, run_key = random.split(key)
+    env_key, run_key, sample_key = random.split(key, 3)
     env = lambda batch_size: make_random_poly_regression_environment(env_key,
                                                                      degree,
                                                                      ntrain,
@@ -150,6 +166,7 @@ def main():
                                                                      shuffle=True)
 
     nsteps = 4
+    sample_keys = random.split(sample_key, nsteps)
 
     buffer_size = ntrain
 
@@ -181,7 +198,7 @@ def main():
                          nepochs=nepochs * nsteps)
 
     nsamples, nwarmup = 100, 50
-    nuts = BlackJaxNutsAgent(
+    nuts = NumpyroNutsAgent(
         loglikelihood_fn,
         model_fn,
         logprior=logprior_fn,
@@ -190,7 +207,7 @@ def main():
         obs_noise=obs_noise,
         buffer_size=buffer_size)
 
-    batch_nuts = BlackJaxNutsAgent(
+    batch_nuts = NumpyroNutsAgent(
         loglikelihood_fn,
         model_fn,
         logprior=logprior_fn,
@@ -298,9 +315,16 @@ def main():
                    degree=degree,
                    obs_noise=obs_noise,
                    timesteps=timesteps,
-                   batch_agents=batch_agents
+                   sample_keys=sample_keys,
+                   nensemble=nensemble,
+                   batch_agents=batch_agents,
+                   preallocate_axes=True
                    )
 
+    plt.tight_layout()
+    plt.savefig("jaks.png")
+    plt.show()
+
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
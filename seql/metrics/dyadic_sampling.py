@@ -81,8 +81,8 @@ def make_nll_polyadic_calculator(
     chex.assert_shape(labels, [kappa, 1])
  
     # Compute log-likehood, and then multiply by tau / kappa repeats.
-    probs = nn.softmax(logits, axis=-1)
-    ll = categorical_log_likelihood(probs, labels)
+    logprobs = nn.log_softmax(logits, axis=-1)
+    ll = categorical_log_likelihood(logprobs, labels)
     num_repeat = tau / kappa
     return ll * num_repeat
  
@@ -1,14 +1,20 @@
 import jax.numpy as jnp
+from jax.scipy.linalg import solve_triangular
 
 import chex
-import distrax
 
 from seql.metrics.utils import average_sampled_log_likelihood
 
 def gaussian_log_likelihood(mu: chex.Array,
                             cov: chex.Array,
                             predictions) -> float:
-    return jnp.sum(distrax.MultivariateNormalFullCovariance(jnp.squeeze(mu, axis=-1), cov).log_prob(predictions))
+    # Closed form, with one Cholesky factor shared by all the predictions.
+    L = jnp.linalg.cholesky(cov)
+    diff = jnp.atleast_2d(predictions - jnp.squeeze(mu))
+    z = solve_triangular(L, diff.T, lower=True)
+    logdet = 2 * jnp.sum(jnp.log(jnp.diag(L)))
+    d = L.shape[-1]
+    return jnp.sum(-0.5 * (d * jnp.log(2 * jnp.pi) + logdet + jnp.sum(z * z, axis=0)))
 
 
 def gaussian_sample_kl(
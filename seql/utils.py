@@ -1,19 +1,23 @@
-from jax.config import config
-config.update("jax_debug_nans", True)
+import os
 
-import jax.numpy as jnp
-from jax import lax, random
+from jax import config
+
+# NaN checking synchronises after every op, so it is opt-in for debugging.
+if os.environ.get("SEQL_DEBUG_NANS"):
+    config.update("jax_debug_nans", True)
 
-import distrax
+import jax.numpy as jnp
+from jax import jit, lax, nn, random
 
 import optax
 
 import chex
-from typing import NamedTuple, Callable, Optional, Tuple
+from functools import partial
+from typing import NamedTuple, Callable, Optional
 
 from seql.agents.base import Agent
 from seql.environments.sequential_data_env import SequentialDataEnvironment
-from seql.metrics.regression import gaussian_sample_kl
+from seql.metrics.regression import gaussian_log_likelihood, gaussian_sample_kl
 
 
 Belief = NamedTuple
@@ -23,16 +27,28 @@ def onehot(labels: chex.Array,
            num_classes: int,
            on_value: float = 1.0,
            off_value: float = 0.0) -> chex.Array:
-    # https://github.com/google/flax/blob/main/examples/imagenet/train.py
-    x = (labels[..., None] == jnp.arange(num_classes).reshape((1,) * labels.ndim + (-1,)))
-    x = lax.select(x, jnp.full(x.shape, on_value), jnp.full(x.shape, off_value))
-    return x.astype(jnp.float32)
+    x = nn.one_hot(labels, num_classes, dtype=jnp.float32)
+    if on_value == 1.0 and off_value == 0.0:
+        return x
+    return x * (on_value - off_value) + off_value
+
+
+def _log1mexp(x: chex.Array) -> chex.Array:
+    # log(1 - exp(x)) for x <= 0, switching between expm1 and log1p at -log(2)
+    # so it stays accurate both near 0 and for large negative x.
+    return jnp.where(x > -jnp.log(2.),
+                     jnp.log(-jnp.expm1(x)),
+                     jnp.log1p(-jnp.exp(x)))
 
 
 def binary_cross_entropy(labels: chex.Array,
                          logprobs: chex.Array) -> float:
-    probs = jnp.exp(logprobs)
-    loss = labels * logprobs + (1 - labels) * jnp.log(1 - probs)
+    # Selecting rather than weighting by the labels keeps a saturated
+    # log prob of 0 from turning into 0 * -inf for the positive labels,
+    # and the masked input keeps that -inf out of the gradient too.
+    is_positive = labels == 1
+    safe_logprobs = jnp.where(is_positive, -1., logprobs)
+    loss = jnp.where(is_positive, logprobs, _log1mexp(safe_logprobs))
     return -jnp.mean(loss)
 
 
@@ -42,34 +58,49 @@ def cross_entropy_loss(labels: chex.Array,
     nclasses = logprobs.shape[-1]
     if nclasses == 1:
         return binary_cross_entropy(labels, logprobs)
-    one_hot_labels = onehot(jnp.squeeze(labels, axis=-1),
-                            num_classes=nclasses)
+    one_hot_labels = nn.one_hot(jnp.squeeze(labels, axis=-1), nclasses)
     xentropy = optax.softmax_cross_entropy(logits=logprobs, labels=one_hot_labels)
     return jnp.mean(xentropy)
 
 
 def categorical_log_likelihood(logprobs: chex.Array,
                                labels: chex.Array) -> float:
-    """Computes joint log likelihood based on probs and labels."""
-    num_data, nclasses = logprobs.shape
+    """Computes joint log likelihood based on log probs and labels."""
+    num_data, _ = logprobs.shape
     assert len(labels) == num_data
-    one_hot_labels = onehot(labels, num_classes=nclasses)
-    assigned_probs = logprobs * one_hot_labels
-    return jnp.sum(jnp.log(assigned_probs))
-
-
-def gaussian_log_likelihood(mu: chex.Array,
-                            cov: chex.Array,
-                            predictions) -> float:
-    return jnp.sum(distrax.MultivariateNormalFullCovariance(jnp.squeeze(mu), cov).log_prob(predictions))
+    labels = labels.reshape((num_data, 1)).astype(jnp.int32)
+    return jnp.sum(jnp.take_along_axis(logprobs, labels, axis=-1))
 
 
+@partial(jit, static_argnames=("model_fn",))
 def mean_squared_error(params: chex.ArrayTree,
                        inputs: chex.Array,
                        outputs: chex.Array,
                        model_fn: Callable) -> float:
     predictions = model_fn(params, inputs)
-    return jnp.sum(jnp.power(predictions - outputs, 2))
+    return jnp.sum(jnp.square(predictions - outputs))
+
+
+def _scan_train(update_keys: chex.Array,
+                initial_belief_state: Belief,
+                agent: Agent,
+                env: SequentialDataEnvironment) -> Belief:
+    # Every batch is gathered up front so that all the updates are traced
+    # once and run as a single XLA program.
+    nsteps = len(update_keys)
+    batches = [env.get_data(t) for t in range(nsteps)]
+    X_train = jnp.stack([x for x, _ in batches])
+    Y_train = jnp.stack([y for _, y in batches])
+
+    def step(belief, inputs):
+        update_key, x, y = inputs
+        belief, info = agent.update(update_key, belief, x, y)
+        return belief, info
+
+    belief, _ = lax.scan(step,
+                         initial_belief_state,
+                         (update_keys, X_train, Y_train))
+    return belief
 
 
 # Main function
@@ -81,16 +112,26 @@ def train(key: chex.PRNGKey,
           nsamples_input: int,
           nsamples_output: int,
           njoint: int,
-          callback: Optional[Callable] = None) -> Tuple[Belief, chex.Array]:
+          callback: Optional[Callable] = None) -> Belief:
 
-    rewards = []
     belief = initial_belief_state
-    keys = random.split(key, nsteps)
-
-    for t, rng_key in enumerate(keys):
+    # All the keys are split in one call rather than once per step
+    keys = random.split(key, 2 * nsteps)
+    update_keys, joint_keys = keys[:nsteps], keys[nsteps:]
+
+    if callback is None:
+        callbacks = ()
+    elif isinstance(callback, (list, tuple)):
+        callbacks = tuple(callback)
+    else:
+        callbacks = (callback,)
+
+    # Without callbacks there are no host side effects between the steps
+    if not callbacks and agent.pure_update:
+        return _scan_train(update_keys, belief, agent, env)
+
+    for t, update_key in enumerate(update_keys):
         X_train, Y_train = env.get_data(t)
-        
-        update_key, joint_key = random.split(rng_key, 2)
 
         belief, info = agent.update(update_key,
                                     belief,
@@ -98,27 +139,21 @@ def train(key: chex.PRNGKey,
                                     Y_train)
 
         
-        '''kl_div = env.evaluate_quality(joint_key, agent, belief, 2)
+        '''kl_div = env.evaluate_quality(joint_keys[t], agent, belief, 2)
         print(kl_div)'''
-        if callback:
-            if not isinstance(callback, list):
-                callback_list = [callback]
-            else:
-                callback_list = callback
-
-            for f in callback_list:
-                f(
-                    agent=agent,
-                    env=env,
-                    belief=belief,
-                    info=info,
-                    X_train=X_train,
-                    Y_train=Y_train,
-                    #kl=kl_div,
-                    t=t
-                )
+        for f in callbacks:
+            f(
+                agent=agent,
+                env=env,
+                belief=belief,
+                info=info,
+                X_train=X_train,
+                Y_train=Y_train,
+                #kl=kl_div,
+                t=t
+            )
 
     
 
-    return belief, rewards
+    return belief
 